@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import sys
 import glob
 import pathlib
@@ -16,17 +15,47 @@ def get_args():
     
     # PD command
     pd_parser = subparsers.add_parser("pd", help="Compute persistence diagrams")
-    pd_parser.add_argument("-i", "--input", nargs="+", help="Input LAMMPS DATA files")
+    pd_parser.add_argument("-i", "--input", nargs="+", help="Input LAMMPS DATA or dump (.dump, .lammpstrj) files")
     pd_parser.add_argument("-o", "--outputdir", default=".", help="Output directory")
+    pd_parser.add_argument("--prescreen", action="store_true", help="Skip chain pairs that cannot thread")
+    pd_parser.add_argument("--engine", choices=["homcloud", "builtin"], default="homcloud", help="Alpha filtration engine (builtin: in-process H1 computation)")
+    pd_parser.add_argument("--executor", choices=["serial", "thread", "process"], default="process", help="Where the pairs of PD_i_cup_j are computed (thread: worker threads of this process)")
+    pd_parser.add_argument("--workers", type=int, default=None, help="Number of worker threads or processes (default: --cores)")
+    pd_parser.add_argument("--cores", type=int, default=None, help="Core budget split between workers and OpenMP/BLAS threads per stage (default: CPUs available to this process)")
+    pd_parser.add_argument("--cutoff", type=float, default=None, help="Only use the beads of chain j within CUTOFF of chain i for the pair (i, j) (approximation, validate first)")
+    pd_parser.add_argument("--queue-size", type=int, default=2, help="Maximum number of frames waiting between read, compute and write")
+    pd_parser.add_argument("--incremental", type=float, default=None, metavar="TOL", help="Reuse the diagrams of chains that moved less than TOL since the previous frame")
+    pd_parser.add_argument("--incremental-metric", choices=["max", "rmsd"], default="max", help="Displacement measure of --incremental")
+    pd_parser.add_argument("--disk-cache", default=None, metavar="FILE", help="SQLite file caching the diagrams by coordinate hash")
+    pd_parser.add_argument("--disk-cache-size", type=float, default=1024, help="Maximum size of --disk-cache in MB")
+    pd_parser.add_argument("--max-fps", type=float, default=None, help="Upper limit of the throughput in frames per second")
+    pd_parser.add_argument("--compression", choices=["gzip", "lzf", "none"], default="gzip", help="Compression filter of the HDF5 files")
+    pd_parser.add_argument("--profile", action="store_true", help="Record the time, CPU time, peak RSS and sizes of each stage (saved in the HDF5 files)")
+    pd_parser.add_argument("--trajectory", default=None, metavar="FILE", help="Append all frames to one multi-frame HDF5 file instead of one file per frame")
+    pd_parser.add_argument("--compression-level", type=int, default=4, help="gzip level of --compression gzip")
 
     # Betti command
     betti_parser = subparsers.add_parser("betti", help="Compute Betti numbers")
-    betti_parser.add_argument("-i", "--input", nargs="+", help="Input HDF5 files")
+    betti_parser.add_argument("-i", "--input", nargs="+", help="Input HDF5 files (single or multi-frame)")
     betti_parser.add_argument("-o", "--outputdir", default=".", help="Output directory")
+    betti_parser.add_argument("--max-alpha", type=float, default=5000, help="Maximum alpha")
+    betti_parser.add_argument("--d-alpha", type=float, default=0.1, help="Alpha step of the linear grid")
+    betti_parser.add_argument("--log-alpha", action="store_true", help="Use a log-spaced alpha grid")
+    betti_parser.add_argument("--min-alpha", type=float, default=1e-3, help="Minimum alpha of the log grid")
+    betti_parser.add_argument("--num-alpha", type=int, default=1000, help="Number of alphas of the log grid")
+    betti_parser.add_argument("--chains", type=int, nargs="+", default=None, help="Only read and use these (passive) chains")
+    betti_parser.add_argument("--chunk-size", type=int, default=64, help="Number of passive chains read from a file at once")
+    betti_parser.add_argument("-n", "--num-processes", type=int, default=None, help="Number of processes reading the files in parallel")
+    betti_parser.add_argument("--cores", type=int, default=None, help="Core budget split between the processes and their OpenMP threads")
 
     # Num threading command
     num_threading_parser = subparsers.add_parser("num_threading", help="Number of threading")
-    num_threading_parser.add_argument("-i", "--input", nargs="+", help="Input HDF5 files")
+    num_threading_parser.add_argument("-i", "--input", nargs="+", help="Input HDF5 files (single or multi-frame)")
+
+    # Cache command
+    cache_parser = subparsers.add_parser("cache", help="Inspect or clear the diagram cache")
+    cache_parser.add_argument("-f", "--file", required=True, help="SQLite file of the cache")
+    cache_parser.add_argument("--clear", action="store_true", help="Remove all entries")
 
     return parser.parse_args()
 
@@ -64,72 +93,131 @@ def _threading(args):
     elapsed_times = [[], [], []]  # pd_i, pd_i_cup_j, threading
     max_alpha = 10000
     delta_alpha = 0.2
-    for filename in args.input:
-        # /path/to/xxx.data -> xxx.h5
-        outputFile = pathlib.Path(filename).stem + ".h5"
-        output_path = pathlib.Path(args.outputdir) / outputFile
 
+    def compute(pds, coords):
+        name = pds.metadata["source"]
         # Single chain
-        pds = ht.HomologicalThreading()
-        coords = pds.read_lmpdata(filename)
         time_start = time.time()
-        pds.pd_i.compute(coords, dim=1, mp=False)
+        pds.pd_i.compute(coords, dim=1, mp=False, engine=args.engine)
         time_end = time.time()
         elapsed_times[0].append(time_end - time_start)
 
         # Pair of chains
         time_start = time.time()
-        pds.pd_i_cup_j.compute(coords, dim=1, mp=True)
+        pds.pd_i_cup_j.compute(coords, dim=1, mp=True, prescreen=args.prescreen, cutoff=args.cutoff, engine=args.engine)
         time_end = time.time()
         elapsed_times[1].append(time_end - time_start)
+        if args.prescreen:
+            print(f"{name}: pruned {pds.pd_i_cup_j.n_pruned} / {len(pds.pd_i_cup_j.pairs)} pairs")
+        if args.cutoff is not None:
+            removed = pds.pd_i_cup_j.removed
+            print(
+                f"{name}: cutoff removed {removed.mean():.1f} / {coords.shape[1]} beads of chain j per pair"
+                f" (min {removed.min()}, max {removed.max()})"
+            )
+        if pds.pd_i_cup_j.utilization:
+            usage = list(pds.pd_i_cup_j.utilization.values())
+            print(f"{name}: worker utilization min {min(usage):.2f} / mean {np.mean(usage):.2f}")
+        if pds.cache is not None:
+            print(
+                f"{name}: cache hit rate pd_i {pds.metadata['cache_hit_rate_pd_i']:.2f}"
+                f" / pd_i_cup_j {pds.metadata['cache_hit_rate_pd_i_cup_j']:.2f}"
+            )
 
         # Threading
         time_start = time.time()
-        pds.threading.compute(pds.pd_i.pd, pds.pd_i_cup_j.pd)
+        pds.threading.compute(pds.pd_i.diagrams, pds.pd_i_cup_j.diagrams)
         time_end = time.time()
         elapsed_times[2].append(time_end - time_start)
 
-        # Save persistence diagrams
-        pds.to_hdf5(output_path)
+    # 全てのファイル (フレーム) で同じ executor (--executor) を使い回し，
+    # 次のフレームの読み込みと前のフレームの書き出しを計算と並行に行う
+    # /path/to/xxx.data -> xxx.h5, /path/to/xxx.dump -> xxx_000000.h5, ...
+    # --incremental: 前のフレームから動いていないチェインの PD を再利用する
+    cache = None
+    if args.incremental is not None:
+        cache = ht.FrameCache(args.incremental, metric=args.incremental_metric)
+    # --disk-cache: 同じ座標の PD は計算せずにキャッシュから読む
+    disk_cache = None
+    if args.disk_cache is not None:
+        disk_cache = ht.DiagramCache(args.disk_cache, max_bytes=int(args.disk_cache_size * 2**20))
+    hdf5_options = {
+        "compression": None if args.compression == "none" else args.compression,
+        "compression_opts": args.compression_level,
+    }
+    # --trajectory: 全てのフレームを 1 つのファイルに追記する
+    trajectory = None
+    if args.trajectory is not None:
+        trajectory = ht.TrajectoryFile(args.trajectory, "a", **hdf5_options)
+    # --profile: フレーム毎の記録は各 HDF5 に，全フレームの合計は total に集める
+    total = ht.Profiler() if args.profile else None
+    profiler = ht.Profiler(collectors=[total.add]) if args.profile else None
+    # --cores: 段階毎にワーカー数と OpenMP/BLAS スレッド数に分けるコアの予算
+    resources = ht.ResourcePlanner(args.cores)
+    try:
+        with ht.make_executor(args.executor, args.workers or resources.cores) as pool:
+            # 読み込みと書き出しのスレッドが動き出す前にワーカープロセスを fork しておく
+            pool.start()
+            pipeline = ht.FramePipeline(
+                args.outputdir, compute=compute, queue_size=args.queue_size, max_fps=args.max_fps,
+                hdf5_options=hdf5_options, trajectory=trajectory,
+            )
+            stats = pipeline.run(ht.pipeline.frames(args.input, pool, cache, disk_cache, profiler, resources))
+    finally:
+        if trajectory is not None:
+            trajectory.close()
 
     print("Mean elapsed time for computing pd_i: ", np.mean(elapsed_times[0]))
     print("Mean elapsed time for computing pd_i_cup_j: ", np.mean(elapsed_times[1]))
     print("Mean elapsed time for computing threading: ", np.mean(elapsed_times[2]))
+    busy = ", ".join(f"{stage} {t:.2f} s" for stage, t in stats["busy"].items())
+    print(f"Throughput: {stats['fps']:.3f} frames/s ({stats['nframes']} frames, {stats['wall_time']:.2f} s; {busy})")
+    for plan in resources.plans.values():
+        print(f"Resource plan {plan}")
+    if total is not None:
+        print(f"{'stage':24s} {'calls':>6s} {'wall [s]':>9s} {'cpu [s]':>9s} {'peak RSS [MB]':>14s} {'items':>9s} {'points':>10s}")
+        for stage, t in total.summary()["stages"].items():
+            print(
+                f"{stage:24s} {t['calls']:6d} {t['wall']:9.3f} {t['cpu']:9.3f} {t['peak_rss'] / 2**20:14.1f}"
+                f" {t['items']:9d} {t['points']:10d}"
+            )
+    if disk_cache is not None:
+        info = disk_cache.info()
+        print(f"Disk cache: {info['hits']} hits, {info['misses']} misses, {info['entries']} entries, {info['bytes'] / 2**20:.1f} MB")
+        disk_cache.close()
 
 
 def _betti(args):
     outputFile = "betti.h5"
     output_path = pathlib.Path(args.outputdir) / outputFile
-    pds = ht.HomologicalThreading()
-    max_alpha = 5000
-    delta_alpha = 0.1
-    betti_pd_i = np.zeros(int(max_alpha / delta_alpha + 1))
-    betti_pd_i_cup_j = np.zeros(int(max_alpha / delta_alpha + 1))
-    betti_threading = np.zeros(int(max_alpha / delta_alpha + 1))
-    for filename in args.input:
-        pds.from_hdf5(filename)
-        alphas, betti = pds.pd_i.betti(max_alpha, delta_alpha)
-        betti_pd_i += betti
-        alphas, betti = pds.pd_i_cup_j.betti(max_alpha, delta_alpha)
-        betti_pd_i_cup_j += betti
-        alphas, betti = pds.threading.betti(max_alpha, delta_alpha)
-        betti_threading += betti
-
-    betti_pd_i /= len(args.input)
-    betti_pd_i_cup_j /= len(args.input)
-    betti_threading /= len(args.input)
+    if args.log_alpha:
+        # log スケールでプロットするための対数等間隔のグリッド
+        alphas = np.geomspace(args.min_alpha, args.max_alpha, args.num_alpha)
+    else:
+        alphas = args.d_alpha * np.arange(int(args.max_alpha / args.d_alpha) + 1)
+    # PD を passive chain の塊ごとに読んで足し込み，ファイルを並列に集計する
+    ensemble = ht.EnsembleBetti(alphas, chains=args.chains, chunk_size=args.chunk_size)
+    resources = ht.ResourcePlanner(args.cores)
+    ensemble.run(args.input, num_processes=args.num_processes, resources=resources)
+    for plan in resources.plans.values():
+        print(f"Resource plan {plan}")
+    summary = ensemble.summary()
     np.savez(
         output_path,
         alphas=alphas,
-        betti_pd_i=betti_pd_i,
-        betti_pd_i_cup_j=betti_pd_i_cup_j,
-        betti_threading=betti_threading,
+        betti_pd_i=summary["pd_i_mean"],
+        betti_pd_i_cup_j=summary["pd_i_cup_j_mean"],
+        betti_threading=summary["threading_mean"],
+        betti_pd_i_std=summary["pd_i_std"],
+        betti_pd_i_cup_j_std=summary["pd_i_cup_j_std"],
+        betti_threading_std=summary["threading_std"],
+        nframes=ensemble.count,
     )
 
 def _num_threading(args):
-    for filename in args.input:
-        pds = ht.HomologicalThreading()
-        pds.from_hdf5(filename)
+    pds = ht.HomologicalThreading()
+    # flags 以外の PD は読まない
+    for _ in _load_frames(pds, args.input):
         n_a, n_p = pds.threading.num_threading()
         print(pds.threading.flags[0])
         print(n_a)
@@ -139,6 +227,28 @@ def _num_threading(args):
         print(np.mean(n_p))
         print(np.std(n_p))
 
+def _load_frames(pds, inputs):
+    """
+    Load every frame of the input files into pds lazily, one by one.
+    Multi-frame files (TrajectoryFile) give all of their frames.
+    """
+    for filename in inputs:
+        if ht.trajectory.is_trajectory(filename):
+            yield from pds.iter_hdf5(filename, lazy=True)
+        else:
+            pds.from_hdf5(filename, lazy=True)
+            yield filename
+            pds.close()
+
+def _cache(args):
+    with ht.DiagramCache(args.file) as cache:
+        if args.clear:
+            cache.clear()
+        for key, value in cache.info().items():
+            if key not in ("hits", "misses", "max_bytes"):
+                print(f"{key}: {value}")
+
+
 def main():
     args = get_args()
     if args.command == "pd":
@@ -147,6 +257,8 @@ def main():
         _betti(args)
     elif args.command == "num_threading":
         _num_threading(args)
+    elif args.command == "cache":
+        _cache(args)
 
 
 if __name__ == "__main__":
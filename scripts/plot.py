@@ -17,6 +17,7 @@ def get_args():
     betti_parser = subparsers.add_parser("betti", help="Compute Betti numbers")
     betti_parser.add_argument("-i", "--input", nargs="+", help="Input npz files")
     betti_parser.add_argument("-o", "--output", default=None, help="Output image file")
+    betti_parser.add_argument("--log", action="store_true", help="Log-scale alpha axis (use with analysis.py betti --log-alpha)")
 
     return parser.parse_args()
 
@@ -27,14 +28,14 @@ def betti(args):
     if num_files == 1:
         axes = [axes]
     for i, input in enumerate(args.input):
-        plot_betti(axes[i], input)
+        plot_betti(axes[i], input, log=args.log)
     if args.output:
         plt.savefig(args.output)
     else:
         plt.show()
 
 
-def plot_betti(ax, input):
+def plot_betti(ax, input, log=False):
     data = np.load(input)
     alphas = data["alphas"]
     betti = data["betti_pd_i"]
@@ -47,8 +48,10 @@ def plot_betti(ax, input):
     print (betti[10:30] / const)
     ax.plot(np.sqrt(alphas), betti / const, label="threading")
 
-    ax.set_xlim(0, 10)
-    # ax.set_xscale("log")
+    if log:
+        ax.set_xscale("log")
+    else:
+        ax.set_xlim(0, 10)
     # ax.set_yscale("log")
     ax.legend()
 
@@ -69,21 +72,25 @@ def pd(args):
     else:
         plt.show()
 
+def read_points(group):
+    # ragged 形式なら全点，古い形式なら NaN padding を含む配列を返す
+    if "points" in group:
+        return group["points"][:]
+    return group["pd"][:].reshape(-1, 2)
+
+
 def plot_pd(ax, input):
     with h5py.File(input, "r") as data:
-        tmp = data["pd_i/pd"][:]
-        tmp = tmp.reshape(-1, 2)
+        tmp = read_points(data["pd_i"])
         # #. of points without nan
         print(np.sum(~np.isnan(tmp[:, 0])))
         ax[0].scatter(tmp[:, 0], tmp[:, 1])
         ax[0].set_title("pd_i")
-        tmp = data["pd_i_cup_j/pd"][:]
-        tmp = tmp.reshape(-1, 2)
+        tmp = read_points(data["pd_i_cup_j"])
         print(np.sum(~np.isnan(tmp[:, 0])))
         ax[1].scatter(tmp[:, 0], tmp[:, 1])
         ax[1].set_title("pd_i_cup_j")
-        tmp = data["threading/pd"][:]
-        tmp = tmp.reshape(-1, 2)
+        tmp = read_points(data["threading"])
         print(np.sum(~np.isnan(tmp[:, 0])))
         ax[2].scatter(tmp[:, 0], tmp[:, 1])
         ax[2].set_title("threading")
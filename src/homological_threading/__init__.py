@@ -1,5 +1,22 @@
-from .fortran import compute
 from .main import HomologicalThreading, compute_betti_number
-from .lammps_io import LammpsData
+from .lammps_io import LammpsData, LammpsDump
+from .diagram import RaggedPD
+from .parallel import SerialExecutor, ThreadExecutor, WorkerPool, make_executor
+from .pipeline import FramePipeline
+from .incremental import FrameCache
+from .cache import DiagramCache
+from .trajectory import TrajectoryFile
+from .ensemble import EnsembleBetti
+from .profiling import Profiler
+from .resources import ResourcePlanner
 
-__all__ = ['compute', 'HomologicalThreading', 'compute_betti_number', 'LammpsData']
+__all__ = ['compute', 'HomologicalThreading', 'compute_betti_number', 'LammpsData', 'LammpsDump', 'RaggedPD', 'SerialExecutor', 'ThreadExecutor', 'WorkerPool', 'make_executor', 'FramePipeline', 'FrameCache', 'DiagramCache', 'TrajectoryFile', 'EnsembleBetti', 'Profiler', 'ResourcePlanner']
+
+
+def __getattr__(name):
+    # Fortran の拡張モジュールは使う時に読み込む
+    if name == "compute":
+        from .fortran import compute
+
+        return compute
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
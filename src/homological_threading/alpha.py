@@ -0,0 +1,144 @@
+"""
+Built-in H1 persistence of alpha filtrations.
+
+小さな点群 (1 本または 2 本の環) の 1 次の PD を homcloud を通さずにメモリ上で計算する．
+scipy の Delaunay 分割から四面体，三角形，辺を作り，アルファ複体のフィルトレーション値
+(homcloud と同じく半径の 2 乗) を上の次元から順に決め，三角形の境界行列を Fortran で簡約する．
+"""
+
+import numpy as np
+
+# PD を計算するエンジン (_alpha_pd の engine 引数)
+ENGINES = ("homcloud", "builtin")
+
+# 四面体の三角形と三角形の辺: m 番目の行は頂点 m を除いた頂点の組 (頂点 m が向かいの頂点)
+_TET_FACES = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+_TRI_EDGES = np.array([[1, 2], [0, 2], [0, 1]])
+
+
+def alpha_h1(points):
+    """
+    Compute the H1 persistence diagram of the alpha filtration of a point cloud.
+
+    The filtration value of a simplex is the squared radius of its smallest
+    empty circumsphere, as in homcloud: tetrahedra get their circumradius;
+    a triangle (edge) gets the radius of its smallest circumsphere unless a
+    vertex of a coface lies inside that sphere, in which case it enters with
+    its first coface. Pairs of zero persistence are dropped.
+
+    args:
+        points: np.array, shape=(npoints, 3)
+
+    return:
+        pd: np.array, shape=(npoints', 2) 0: birth, 1: death, sorted by birth then death
+    """
+    from scipy.spatial import Delaunay
+    from .fortran import compute as fc
+
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    if len(points) < 4:
+        return np.zeros((0, 2))
+    tets = np.sort(Delaunay(points).simplices, axis=1)
+    if len(tets) == 0:
+        return np.zeros((0, 2))
+
+    # 四面体の面 (三角形) と向かいの頂点．頂点の組は 1 つの整数にしてから重複を除く
+    n = np.int64(len(points))
+    faces = tets[:, _TET_FACES].reshape(-1, 3).astype(np.int64)
+    keys, tet_face = np.unique((faces[:, 0] * n + faces[:, 1]) * n + faces[:, 2], return_inverse=True)
+    tri = np.stack([keys // (n * n), keys // n % n, keys % n], axis=1)
+    tet_opposite = tets.ravel()
+    # 三角形の辺と向かいの頂点
+    sides = tri[:, _TRI_EDGES].reshape(-1, 2)
+    keys, tri_edge = np.unique(sides[:, 0] * n + sides[:, 1], return_inverse=True)
+    edges = np.stack([keys // n, keys % n], axis=1)
+    tri_opposite = tri.ravel()
+
+    # 上の次元から順にフィルトレーション値を決める
+    tet_value = _tet_radius2(points[tets])
+    center, radius2 = _triangle_sphere(points[tri])
+    tri_value = _attach(
+        radius2, tet_face, np.repeat(tet_value, 4),
+        _inside(points[tet_opposite], center[tet_face], radius2[tet_face]),
+    )
+    a, b = points[edges[:, 0]], points[edges[:, 1]]
+    center, radius2 = 0.5 * (a + b), 0.25 * np.einsum("ij,ij->i", a - b, a - b)
+    edge_value = _attach(
+        radius2, tri_edge, np.repeat(tri_value, 3),
+        _inside(points[tri_opposite], center[tri_edge], radius2[tri_edge]),
+    )
+
+    # 辺と三角形をフィルトレーション順に並べ，境界行列を簡約する
+    edge_order = np.argsort(edge_value, kind="stable")
+    edge_rank = np.empty(len(edges), dtype=np.int32)
+    edge_rank[edge_order] = np.arange(1, len(edges) + 1, dtype=np.int32)
+    tri_order = np.argsort(tri_value, kind="stable")
+    boundary = edge_rank[tri_edge.reshape(-1, 3)[tri_order]]
+    low = fc.h1_reduction(boundary.T, len(edges))
+
+    paired = np.nonzero(low > 0)[0]
+    births = edge_value[edge_order[low[paired] - 1]]
+    deaths = tri_value[tri_order[paired]]
+    keep = deaths > births
+    pd = np.stack([births[keep], deaths[keep]], axis=1)
+    return pd[np.lexsort((pd[:, 1], pd[:, 0]))]
+
+
+def _tet_radius2(p):
+    """
+    Squared circumradii of tetrahedra p, shape=(ntets, 4, 3).
+    """
+    d = p[:, 1:] - p[:, :1]
+    rhs = 0.5 * np.einsum("tij,tij->ti", d, d)
+    # 体積 0 の四面体の外接球は無限大
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = np.linalg.det(d)
+        center = np.linalg.solve(np.where(np.abs(det)[:, None, None] > 0, d, np.eye(3)), rhs[..., None])[..., 0]
+    radius2 = np.einsum("ti,ti->t", center, center)
+    radius2[det == 0] = np.inf
+    return radius2
+
+
+def _triangle_sphere(p):
+    """
+    Centre and squared radius of the smallest circumsphere of triangles p, shape=(ntri, 3, 3).
+    """
+    a = p[:, 1] - p[:, 0]
+    b = p[:, 2] - p[:, 0]
+    n = np.cross(a, b)
+    aa = np.einsum("ij,ij->i", a, a)
+    bb = np.einsum("ij,ij->i", b, b)
+    nn = np.einsum("ij,ij->i", n, n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = np.cross(aa[:, None] * b - bb[:, None] * a, n) / (2.0 * nn[:, None])
+    radius2 = np.einsum("ij,ij->i", offset, offset)
+    radius2[nn == 0] = np.inf
+    return p[:, 0] + offset, radius2
+
+
+def _inside(q, center, radius2):
+    """True if the points q lie strictly inside the spheres (center, radius2)."""
+    d = q - center
+    return np.einsum("ij,ij->i", d, d) < radius2
+
+
+def _attach(radius2, face, coface_value, inside):
+    """
+    Filtration values of faces from those of their cofaces.
+
+    args:
+        radius2: np.array, shape=(nfaces), squared radius of the smallest circumsphere of each face
+        face: np.array, shape=(nincidences), face of each (coface, face) incidence
+        coface_value: np.array, shape=(nincidences), filtration value of the coface
+        inside: np.array of bool, shape=(nincidences), the vertex of the coface opposite
+            to the face lies inside the smallest circumsphere of the face
+
+    return:
+        value: np.array, shape=(nfaces)
+    """
+    first = np.full(len(radius2), np.inf)
+    np.minimum.at(first, face, coface_value)
+    attached = np.zeros(len(radius2), dtype=bool)
+    attached[face[inside]] = True
+    # 小さい外接球が空でない面は，最初の余面と同時に現れる
+    return np.where(attached, first, radius2)
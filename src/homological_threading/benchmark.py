@@ -0,0 +1,476 @@
+"""
+Benchmark suite with synthetic ring polymer melts.
+
+乱数の seed から決まる環状高分子のメルト (指定したペアは必ずスレッディングする) を作り，
+PD_i, PD_i_cup_j, Threading.compute, ベッティ数，入出力の各段階の時間を測って JSON に保存する．
+PD の計算は指定した executor (serial, thread, process) 毎に測る．
+同じ環境で測った 2 つの結果を compare で比べて性能の劣化を見つける．
+data/N10M100.data があれば基準のケースとして必ず測る．
+import にかかる時間も新しいプロセスで測り，予算 (IMPORT_BUDGET) を超えていないか確かめる．
+
+Usage:
+    python -m homological_threading.benchmark run -o bench.json --grid 10x100 20x100
+    python -m homological_threading.benchmark run --executor serial thread process --workers 4
+    python -m homological_threading.benchmark compare old.json new.json
+    python -m homological_threading.benchmark import --budget 0.3
+"""
+
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .lammps_io import LammpsData
+from .main import HomologicalThreading, version
+from .parallel import EXECUTORS, make_executor
+
+# 計測する段階 (この順に実行する)
+STAGES = (
+    "read_lmpdata",
+    "pd_i",
+    "pd_i_cup_j",
+    "threading",
+    "betti_pd_i",
+    "betti_pd_i_cup_j",
+    "betti_threading",
+    "to_hdf5",
+    "from_hdf5",
+    "append_hdf5",
+)
+
+# (nbeads, nchains)
+DEFAULT_GRID = ((10, 50), (10, 100), (20, 100))
+
+# 基準のケース
+BASELINE = pathlib.Path(__file__).resolve().parents[2] / "data" / "N10M100.data"
+
+# import homological_threading にかける時間の上限 [s]
+IMPORT_BUDGET = 0.3
+
+# import homological_threading で読み込んではいけないモジュール (使う時に読み込む)
+DEFERRED_MODULES = ("homcloud", "h5py", "matplotlib", "scipy", "homological_threading.fortran.compute")
+
+# 新しいプロセスで import の時間と読み込まれたモジュールを調べるコード
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "loaded": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def ring_melt(nchains, nbeads, density=0.85, threading_pairs=0, bond_length=1.0, jitter=0.05, seed=0):
+    """
+    Generate a melt of ring polymers.
+
+    Every ring is a regular polygon with bond length bond_length, randomly
+    oriented and placed in a cubic box of number density density, with
+    random displacements of jitter * bond_length (so that the alpha complexes
+    are not degenerate). For each pair (i, j) of threading_pairs, ring j is
+    moved so that it passes through the centre of ring i. The result only
+    depends on the arguments.
+
+    args:
+        nchains: int
+        nbeads: int
+        density: float, number of beads per unit volume
+        threading_pairs: int or list of (i, j). An int n gives the pairs (0, 1), (2, 3), ..., n pairs.
+        bond_length: float
+        jitter: float, random displacement of the beads relative to bond_length
+        seed: int
+
+    return:
+        coords: np.array, shape=(nchains, nbeads, 3), unwrapped coordinates
+        box_length: float
+        pairs: np.array, shape=(npairs, 2), the threading pairs
+    """
+    rng = np.random.default_rng(seed)
+    box_length = (nchains * nbeads / density) ** (1.0 / 3.0)
+    radius = bond_length / (2.0 * np.sin(np.pi / nbeads))
+    t = 2.0 * np.pi * np.arange(nbeads) / nbeads
+    circle = radius * np.stack([np.cos(t), np.sin(t)], axis=1)  # shape: (nbeads, 2)
+
+    # 各リングの向き: 直交行列の 0, 1 列目が面内，2 列目が法線
+    frames, _ = np.linalg.qr(rng.normal(size=(nchains, 3, 3)))
+    centers = rng.uniform(0.0, box_length, size=(nchains, 3))
+
+    if np.isscalar(threading_pairs):
+        n = min(int(threading_pairs), nchains // 2)
+        pairs = np.stack([2 * np.arange(n), 2 * np.arange(n) + 1], axis=1)
+    else:
+        pairs = np.asarray(threading_pairs, dtype=np.int64).reshape(-1, 2)
+    for i, j in pairs:
+        # j を i の面内の方向 u と法線 n が張る面に置き，i の中心を通るようにする
+        u, n = frames[i][:, 0], frames[i][:, 2]
+        frames[j] = np.stack([u, n, np.cross(u, n)], axis=1)
+        centers[j] = centers[i] + radius * u
+
+    coords = centers[:, None, :] + np.einsum("mk,cdk->cmd", circle, frames[:, :, :2])
+    coords += jitter * bond_length * rng.normal(size=coords.shape)
+    return coords, box_length, pairs
+
+
+def write_lammps_data(filename, coords, box_length):
+    """
+    Write a melt to a LAMMPS data file (wrapped coordinates with image flags, ring bonds).
+    """
+    nchains, nbeads, _ = coords.shape
+    unwrapped = coords.reshape(-1, 3)
+    image = np.floor(unwrapped / box_length)
+    data = LammpsData()
+    data.box.x = data.box.y = data.box.z = (0.0, box_length)
+    data.box.lx = data.box.ly = data.box.lz = box_length
+    data.masses.id = [1]
+    data.masses.mass = [1.0]
+    atoms = data.atoms
+    atoms.num_atoms = nchains * nbeads
+    atoms.num_mols = nchains
+    atoms.num_types = 1
+    atoms.id = np.arange(1, atoms.num_atoms + 1)
+    atoms.mol_id = np.repeat(np.arange(1, nchains + 1), nbeads)
+    atoms.type = np.ones(atoms.num_atoms, dtype=int)
+    atoms.coords = (unwrapped - image * box_length).tolist()
+    atoms.image_flag = image.astype(int).tolist()
+    bonds = data.bonds
+    bonds.num_bonds = nchains * nbeads
+    bonds.num_types = 1
+    bonds.id = np.arange(1, bonds.num_bonds + 1)
+    bonds.type = np.ones(bonds.num_bonds, dtype=int)
+    first = atoms.id.reshape(nchains, nbeads)
+    bonds.atoms = np.stack([first, np.roll(first, -1, axis=1)], axis=2).reshape(-1, 2)
+    data.write(filename)
+
+
+def run_case(name, datafile, repeat=3, stages=STAGES, executor="serial", workers=None, workdir=None):
+    """
+    Time the stages of one LAMMPS data file.
+
+    Each repetition runs all stages in order on a new HomologicalThreading.
+    PD_i and PD_i_cup_j run on one executor started before the first
+    repetition, so the start-up of the workers is not timed.
+
+    return:
+        records: list of dict, one per stage
+    """
+    workdir = pathlib.Path(workdir or tempfile.mkdtemp())
+    times = {stage: [] for stage in stages}
+    counts = {}
+    alphas = 0.1 * np.arange(501)
+    pool = make_executor(executor, workers)
+    try:
+        for r in range(repeat):
+            pds = HomologicalThreading()
+            single = workdir / f"{name}.h5"
+            trajectory = workdir / f"{name}_traj.h5"
+            if trajectory.exists():
+                trajectory.unlink()
+            steps = {
+                "read_lmpdata": lambda: pds.read_lmpdata(str(datafile)),
+                "pd_i": lambda: pds.pd_i.compute(coords, dim=1, executor=pool),
+                "pd_i_cup_j": lambda: pds.pd_i_cup_j.compute(coords, dim=1, executor=pool),
+                "threading": lambda: pds.threading.compute(pds.pd_i.diagrams, pds.pd_i_cup_j.diagrams),
+                "betti_pd_i": lambda: pds.pd_i.betti(alphas=alphas),
+                "betti_pd_i_cup_j": lambda: pds.pd_i_cup_j.betti(alphas=alphas),
+                "betti_threading": lambda: pds.threading.betti(alphas=alphas),
+                "to_hdf5": lambda: pds.to_hdf5(single),
+                "from_hdf5": lambda: HomologicalThreading().from_hdf5(single),
+                "append_hdf5": lambda: pds.append_hdf5(trajectory),
+            }
+            # 計測しない段階でも後の段階に必要なものは計算する
+            needed = _needed(stages)
+            coords = pds.read_lmpdata(str(datafile)) if "read_lmpdata" not in stages else None
+            for stage in STAGES:
+                if stage not in stages and stage not in needed:
+                    continue
+                start = time.perf_counter()
+                result = steps[stage]()
+                elapsed = time.perf_counter() - start
+                if stage == "read_lmpdata":
+                    coords = result
+                if stage in stages:
+                    times[stage].append(elapsed)
+            counts = {
+                "nchains": int(coords.shape[0]),
+                "nbeads": int(coords.shape[1]),
+                "npoints_pd_i": _npoints(pds.pd_i.diagrams),
+                "npoints_pd_i_cup_j": _npoints(pds.pd_i_cup_j.diagrams),
+                "npoints_threading": _npoints(pds.threading.diagrams),
+            }
+    finally:
+        pool.close()
+    return [
+        dict(
+            case=name, executor=executor, workers=pool.num_workers, stage=stage, times=t, min=min(t), mean=float(np.mean(t)),
+            **counts,
+        )
+        for stage, t in times.items()
+    ]
+
+
+def run(
+    grid=DEFAULT_GRID, repeat=3, stages=STAGES, executors=("serial",), workers=None, baseline=True, density=0.85, seed=0,
+    log=print,
+):
+    """
+    Run the benchmark over a grid of synthetic melts (and the baseline N10M100).
+
+    args:
+        grid: list of (nbeads, nchains)
+        repeat: int, repetitions of each case
+        stages: tuple of str, stages to time (see STAGES)
+        executors: tuple of str, executors of PD_i and PD_i_cup_j to time (see parallel.EXECUTORS)
+        workers: int, number of workers of the thread and process executors (None: default_workers())
+        baseline: bool, include data/N10M100.data if it exists
+        density, seed: parameters of ring_melt
+        log: callable(str) or None
+
+    return:
+        results: dict, "environment" and "results" (list of records)
+    """
+    records = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cases = []
+        if baseline and BASELINE.exists():
+            cases.append(("N10M100", BASELINE))
+        for nbeads, nchains in grid:
+            name = f"synthetic_N{nbeads}M{nchains}"
+            coords, box_length, _ = ring_melt(nchains, nbeads, density=density, threading_pairs=nchains // 10, seed=seed)
+            datafile = pathlib.Path(workdir) / f"{name}.data"
+            write_lammps_data(datafile, coords, box_length)
+            cases.append((name, datafile))
+        for name, datafile in cases:
+            for executor in executors:
+                case_records = run_case(
+                    name, datafile, repeat=repeat, stages=stages, executor=executor, workers=workers, workdir=workdir
+                )
+                records += case_records
+                if log is not None:
+                    for record in case_records:
+                        log(
+                            f"{name:24s} {executor:8s} {record['stage']:18s}"
+                            f" min {record['min']:.4f} s  mean {record['mean']:.4f} s"
+                        )
+    record = import_time(repeat=max(repeat, 3))
+    records.append(record)
+    if log is not None:
+        log(f"{'import':24s} {'':8s} {record['stage']:18s} min {record['min']:.4f} s  mean {record['mean']:.4f} s")
+    return {"environment": environment(executors=list(executors), workers=workers, repeat=repeat, density=density, seed=seed), "results": records}
+
+
+def import_time(module="homological_threading", repeat=5, deferred=DEFERRED_MODULES):
+    """
+    Time a cold import of module in new interpreter processes.
+
+    args:
+        module: str, module to import
+        repeat: int, number of processes
+        deferred: tuple of str, modules which must not be loaded by the import
+
+    return:
+        record: dict
+            case: "import", stage: module, times, min, mean: seconds
+            loaded: list of str, modules of deferred that were loaded
+            top: list of (module, seconds), slowest imports (cumulative, -X importtime) of the fastest run
+    """
+    env = dict(os.environ)
+    # インストールしていなくても src の中のパッケージを import できるようにする
+    src = str(pathlib.Path(__file__).resolve().parents[1])
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    code = _IMPORT_PROBE.format(module=module, deferred=tuple(deferred))
+    times = []
+    loaded = []
+    top = []
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True, check=True
+        )
+        result = json.loads(proc.stdout.splitlines()[-1])
+        if not times or result["time"] < min(times):
+            top = _slowest_imports(proc.stderr)
+        times.append(result["time"])
+        loaded = sorted(set(loaded) | set(result["loaded"]))
+    return {
+        "case": "import", "stage": module, "times": times, "min": min(times), "mean": float(np.mean(times)),
+        "loaded": loaded, "top": top,
+    }
+
+
+def _slowest_imports(stderr, n=10):
+    """
+    Imports with the largest cumulative time in the output of -X importtime.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((name.strip(), int(cumulative) * 1e-6))
+    return sorted(rows, key=lambda row: -row[1])[:n]
+
+
+def environment(**options):
+    """
+    Versions and machine of a benchmark run.
+    """
+    packages = {}
+    for package in ("numpy", "h5py", "homcloud", "scipy"):
+        try:
+            packages[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            packages[package] = None
+    return {
+        "version": version,
+        "python": sys.version.split()[0],
+        "packages": packages,
+        "platform": platform.platform(),
+        "machine": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "omp_num_threads": os.environ.get("OMP_NUM_THREADS"),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "options": options,
+    }
+
+
+def save(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=1)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare the minimum times of two benchmark results.
+
+    args:
+        old, new: dict returned by run() (or load())
+        threshold: float, relative slow-down reported as a regression
+
+    return:
+        rows: list of dict (case, executor, stage, old, new, ratio, regression) for the
+            (case, executor, stage) found in both
+    """
+    before = {_key(old, r): r["min"] for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        key = _key(new, r)
+        if key not in before:
+            continue
+        ratio = r["min"] / before[key] if before[key] > 0 else float("inf")
+        rows.append(
+            {
+                "case": key[0], "executor": key[1], "stage": key[2], "old": before[key], "new": r["min"],
+                "ratio": ratio, "regression": ratio > 1.0 + threshold,
+            }
+        )
+    return rows
+
+
+def _key(results, record):
+    """
+    (case, executor, stage) of a record. Results written before the executors
+    were added have the mp option instead (mp=True: process pool).
+    """
+    executor = record.get("executor")
+    if executor is None and record["case"] != "import":
+        executor = "process" if results["environment"]["options"].get("mp") else "serial"
+    return record["case"], executor or "", record["stage"]
+
+
+def _needed(stages):
+    """
+    Stages that must run before the requested ones.
+    """
+    requires = {
+        "pd_i_cup_j": ("pd_i",),
+        "threading": ("pd_i", "pd_i_cup_j"),
+        "betti_pd_i": ("pd_i",),
+        "betti_pd_i_cup_j": ("pd_i_cup_j",),
+        "betti_threading": ("pd_i", "pd_i_cup_j", "threading"),
+        "to_hdf5": ("pd_i", "pd_i_cup_j", "threading"),
+        "from_hdf5": ("pd_i", "pd_i_cup_j", "threading", "to_hdf5"),
+        "append_hdf5": ("pd_i", "pd_i_cup_j", "threading"),
+    }
+    needed = set()
+    for stage in stages:
+        needed.update(requires.get(stage, ()))
+    return needed
+
+
+def _npoints(diagrams):
+    return None if diagrams is None else int(diagrams.offsets[-1])
+
+
+def _parse_grid(text):
+    nbeads, nchains = text.lower().split("x")
+    return int(nbeads), int(nchains)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of homological threading")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmark")
+    run_parser.add_argument("-o", "--output", default="benchmark.json", help="Output JSON file")
+    run_parser.add_argument("--grid", nargs="*", type=_parse_grid, default=list(DEFAULT_GRID), metavar="NBEADSxNCHAINS", help="Sizes of the synthetic melts")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Repetitions of each case")
+    run_parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to time")
+    run_parser.add_argument("--executor", nargs="+", choices=list(EXECUTORS), default=["serial"], help="Executors of PD_i and PD_i_cup_j to time")
+    run_parser.add_argument("--workers", type=int, default=None, help="Number of workers of the thread and process executors")
+    run_parser.add_argument("--no-baseline", action="store_true", help="Skip data/N10M100.data")
+    run_parser.add_argument("--density", type=float, default=0.85, help="Bead density of the synthetic melts")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic melts")
+    compare_parser = subparsers.add_parser("compare", help="Compare two benchmark results")
+    compare_parser.add_argument("old", help="JSON file of the reference run")
+    compare_parser.add_argument("new", help="JSON file of the new run")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative slow-down reported as a regression")
+    import_parser = subparsers.add_parser("import", help="Time the import of the package against a budget")
+    import_parser.add_argument("--module", default="homological_threading", help="Module to import")
+    import_parser.add_argument("--repeat", type=int, default=5, help="Number of interpreter processes")
+    import_parser.add_argument("--budget", type=float, default=IMPORT_BUDGET, help="Maximum import time in seconds")
+    import_parser.add_argument("-o", "--output", default=None, help="Output JSON file")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        results = run(
+            args.grid, repeat=args.repeat, stages=tuple(args.stages), executors=tuple(args.executor), workers=args.workers,
+            baseline=not args.no_baseline, density=args.density, seed=args.seed,
+        )
+        save(results, args.output)
+        print(f"Saved {len(results['results'])} records to {args.output}")
+        return 0
+
+    if args.command == "import":
+        record = import_time(args.module, repeat=args.repeat)
+        if args.output is not None:
+            save({"environment": environment(repeat=args.repeat), "results": [record]}, args.output)
+        print(f"import {args.module}: min {record['min']:.4f} s  mean {record['mean']:.4f} s  (budget {args.budget:.4f} s)")
+        for name, seconds in record["top"]:
+            print(f"  {name:48s} {seconds:.4f} s")
+        if record["loaded"]:
+            print(f"Loaded at import time: {', '.join(record['loaded'])}")
+        # 予算を超えるか，遅らせるべきモジュールを読み込んでいれば終了コード 1
+        return 1 if record["min"] > args.budget or record["loaded"] else 0
+
+    rows = compare(load(args.old), load(args.new), threshold=args.threshold)
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"{row['case']:24s} {row['executor']:8s} {row['stage']:18s} {row['old']:.4f} -> {row['new']:.4f} s  x{row['ratio']:.2f}{flag}")
+    # 劣化があれば終了コード 1
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Content-addressed on-disk cache of persistence diagrams.
+
+アルファ複体の PD は点群の座標と次元 (と計算したエンジン) で決まるので，座標のバイト列，dim と
+エンジンのハッシュをキーにして SQLite のファイルに保存しておく．同じ座標を再び計算する時 (threshold を変えた
+再解析など) は homcloud を呼ばずにキャッシュから読み込む．
+"""
+
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def engine_version(engine):
+    """
+    Engine name with its version for the cache keys, e.g. "homcloud-4.6.0".
+    The version of HomCloud is read from the package metadata without importing it.
+    """
+    if engine != "homcloud":
+        return engine
+    from importlib import metadata
+
+    try:
+        return f"homcloud-{metadata.version('homcloud')}"
+    except metadata.PackageNotFoundError:
+        return "homcloud"
+
+
+class DiagramCache:
+    """
+    Persistent cache of the diagrams of chains and chain pairs.
+
+    Entries are keyed by the SHA-256 of the coordinate bytes, their shape,
+    dim and the engine (with the HomCloud version for "homcloud": the engines
+    do not return identical arrays), and are stored in a single SQLite file. When the total size of the
+    diagrams exceeds max_bytes, the least recently used entries are removed.
+
+    Usage:
+        cache = DiagramCache("~/.cache/homological_threading/diagrams.sqlite", max_bytes=2**30)
+        pds = HomologicalThreading(disk_cache=cache)
+        ...
+        print(cache.info())
+        cache.clear()
+
+    Attributes:
+        path: str, path to the SQLite file
+        max_bytes: int, upper limit of the total size of the diagrams
+        hits: int, number of diagrams read from the cache in this session
+        misses: int, number of diagrams that were not in the cache
+    """
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = os.path.expanduser(str(path))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # パイプラインでは読み込みと計算が別のスレッドなので，スレッド間で共有する (_lock で保護)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS diagrams ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, nbytes INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS diagrams_last_access ON diagrams (last_access)")
+
+    @staticmethod
+    def key(points, dim=1, engine="homcloud"):
+        """
+        Return the key of the diagram of a point cloud.
+
+        args:
+            points: np.array, shape=(npoints, 3)
+            dim: int, dimension of the homology group
+            engine: str, engine that computes the diagram (see alpha.ENGINES)
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        h = hashlib.sha256()
+        h.update(f"{points.shape}:{dim}:{engine_version(engine)}:".encode())
+        h.update(points.tobytes())
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        """
+        Look up several keys at once.
+
+        return:
+            found: dict, key -> np.array of shape (npoints, 2), only for the keys in the cache
+        """
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # SQLite のプレースホルダーの数の上限を超えないように分ける
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, data FROM diagrams WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, data in rows:
+                    found[key] = np.frombuffer(data, dtype="<f8").reshape(-1, 2).copy()
+            if found:
+                now = time.time()
+                with self._db:
+                    self._db.executemany(
+                        "UPDATE diagrams SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+                    )
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store several diagrams and evict the least recently used entries if needed.
+
+        args:
+            items: iterable of (key, np.array of shape (npoints, 2))
+        """
+        now = time.time()
+        rows = []
+        for key, pd in items:
+            data = np.ascontiguousarray(pd, dtype="<f8").tobytes()
+            rows.append((key, data, len(data), now))
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO diagrams (key, data, nbytes, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+            self._evict()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM diagrams").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 古いものから順に，上限を下回るまで消す
+        excess = total - self.max_bytes
+        removed = 0
+        keys = []
+        for key, nbytes in self._db.execute("SELECT key, nbytes FROM diagrams ORDER BY last_access"):
+            keys.append((key,))
+            removed += nbytes
+            if removed >= excess:
+                break
+        self._db.executemany("DELETE FROM diagrams WHERE key = ?", keys)
+
+    def info(self):
+        """
+        Return a summary of the cache.
+
+        return:
+            info: dict with path, entries, bytes, max_bytes, hits and misses
+        """
+        with self._lock:
+            entries, nbytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM diagrams"
+            ).fetchone()
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM diagrams")
+        with self._lock:
+            self._db.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
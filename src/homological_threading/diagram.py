@@ -0,0 +1,334 @@
+"""
+Ragged storage of persistence diagrams.
+
+各チェイン（またはチェインのペア）の PD は点の数がバラバラなので，
+NaN で padding した密な配列ではなく，全点を 1 つの配列に詰めて
+オフセットで区切る CSR 形式で保持する．
+HDF5 には passive chain 毎のチャンクに分けて圧縮して書き出し，
+LazyRaggedPD で必要なチェインの点だけを読み込む．
+"""
+
+import numpy as np
+
+
+class RaggedPD:
+    """
+    CSR-style container for a grid of persistence diagrams.
+
+    The points of all diagrams are stored in one flat array. Each segment
+    points[offsets[s]:offsets[s + 1]] is one diagram, and every cell of the
+    grid (a chain for PD_i, a (passive, active) pair for PD_i_cup_j and
+    Threading) refers to a segment through index. Several cells may share
+    the same segment, e.g. (i, j) and (j, i) of PD_i_cup_j.
+
+    The arrays are C-contiguous float64 and int64, so that points.T,
+    offsets and index.T are exactly the (2, total_points), (nsegments + 1)
+    and (active, passive) Fortran arrays of the kernels in fortran/compute.f90
+    and f2py passes them without a copy.
+
+    Attributes:
+        points: np.array, shape=(total_points, 2) 0: birth, 1: death
+        offsets: np.array, shape=(nsegments + 1)
+        index: np.array, shape=cell_shape, segment of each cell, -1 for an empty cell
+    """
+
+    def __init__(self, points, offsets, index):
+        self.points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.index = np.ascontiguousarray(index, dtype=np.int64)
+
+    @classmethod
+    def from_list(cls, diagrams, index=None):
+        """
+        Build the container from a list of diagrams.
+
+        args:
+            diagrams: list of np.array, shape=(nsegments, npoints, 2)
+            index: np.array, segment of each cell. Defaults to one cell per diagram.
+        """
+        counts = np.array([len(pd) for pd in diagrams], dtype=np.int64)
+        offsets = np.zeros(len(diagrams) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if len(diagrams) > 0:
+            points = np.concatenate(
+                [np.asarray(pd, dtype=np.float64).reshape(-1, 2) for pd in diagrams]
+            )
+        else:
+            points = np.empty((0, 2))
+        if index is None:
+            index = np.arange(len(diagrams))
+        return cls(points, offsets, index)
+
+    @classmethod
+    def from_dense(cls, pd):
+        """
+        Build the container from a NaN-padded array.
+
+        args:
+            pd: np.array, shape=(..., npoints, 2)
+        """
+        pd = np.asarray(pd, dtype=np.float64)
+        cell_shape = pd.shape[:-2]
+        # 点の数の大きさのマスク 1 つだけを使い回す (pd と同じ大きさの一時配列を作らない)
+        valid = np.isnan(pd[..., 0])
+        valid |= np.isnan(pd[..., 1])
+        np.logical_not(valid, out=valid)
+        counts = valid.reshape(-1, pd.shape[-2]).sum(axis=1)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        index = np.arange(len(counts)).reshape(cell_shape)
+        return cls(pd[valid], offsets, index)
+
+    @classmethod
+    def read(cls, group, lazy=False):
+        """
+        Read the container from an HDF5 group written by write().
+        Groups of older files that only hold a dense "pd" dataset are converted.
+
+        args:
+            group: h5py.Group
+            lazy: bool, return a LazyRaggedPD that reads the points on demand.
+                The file must stay open while it is used.
+        """
+        if "points" not in group:
+            return cls.from_dense(group["pd"][:])
+        if lazy:
+            return LazyRaggedPD(group["points"], group["offsets"][:], group["index"][:])
+        return cls(group["points"][:], group["offsets"][:], group["index"][:])
+
+    def write(self, group, compression="gzip", compression_opts=4, shuffle=True):
+        """
+        Write the container to an HDF5 group.
+
+        points is chunked so that one chunk holds about the points of one
+        passive chain (first axis of the cells), and every dataset is compressed.
+
+        args:
+            group: h5py.Group
+            compression: str, "gzip", "lzf" or None
+            compression_opts: int, gzip level (ignored for the other filters)
+            shuffle: bool, apply the shuffle filter before compression
+        """
+        options = filter_options(compression, compression_opts, shuffle)
+        # index の 1 行 (passive chain) が 1 チャンクに収まるようにする
+        index_chunks = (1,) * (self.index.ndim - 1) + self.index.shape[-1:]
+        for name, data, chunks in (
+            ("points", self.points, (self.chunk_rows(), 2)),
+            ("offsets", self.offsets, (1 << 16,)),
+            ("index", self.index, index_chunks),
+        ):
+            if data.size == 0:
+                # 空のデータセットはチャンクに分けられない
+                group.create_dataset(name, data=data)
+                continue
+            chunks = tuple(min(c, n) for c, n in zip(chunks, data.shape))
+            group.create_dataset(name, data=data, chunks=chunks, **options)
+
+    def chunk_rows(self, min_rows=1 << 10, max_rows=1 << 16):
+        """
+        Number of points per HDF5 chunk: the mean number of points of a passive chain.
+        """
+        nrows = self.cell_shape[0] if len(self.cell_shape) > 0 else 1
+        rows = len(self.points) // max(nrows, 1)
+        return int(min(max(rows, min_rows), max_rows))
+
+    @property
+    def cell_shape(self):
+        return self.index.shape
+
+    @property
+    def nsegments(self):
+        return len(self.offsets) - 1
+
+    @property
+    def segment_counts(self):
+        """Number of points of each segment, shape=(nsegments)."""
+        return np.diff(self.offsets)
+
+    @property
+    def counts(self):
+        """Number of points of each cell, shape=cell_shape."""
+        seg_counts = self.segment_counts
+        return np.where(self.index >= 0, seg_counts[np.maximum(self.index, 0)], 0)
+
+    @property
+    def max_npoints(self):
+        return int(self.counts.max(initial=0))
+
+    @property
+    def shape(self):
+        """Shape of the dense NaN-padded view."""
+        return self.cell_shape + (max(self.max_npoints, 1), 2)
+
+    @property
+    def nbytes(self):
+        return self.points.nbytes + self.offsets.nbytes + self.index.nbytes
+
+    def __getitem__(self, cell):
+        """Return the diagram of a cell as a view, shape=(npoints, 2)."""
+        s = self.index[cell]
+        if s < 0:
+            return self.points[:0]
+        return self.points[self.offsets[s] : self.offsets[s + 1]]
+
+    def select(self, cells=Ellipsis):
+        """
+        Concatenate the diagrams of the selected cells.
+
+        args:
+            cells: anything that indexes index (int, slice, boolean mask, ...)
+
+        return:
+            points: np.array, shape=(npoints, 2)
+        """
+        segs = np.atleast_1d(self.index[cells]).ravel()
+        segs = segs[segs >= 0]
+        seg_counts = self.segment_counts
+        return self.points[_ranges(self.offsets[segs], seg_counts[segs])]
+
+    def packed(self):
+        """
+        Points of all cells in cell order with one offset per cell, the layout
+        of pd_i in the Fortran kernels. Without a copy when every cell has its
+        own segment in cell order (e.g. PD_i).
+
+        return:
+            points: np.array, shape=(npoints, 2)
+            offsets: np.array, shape=(ncells + 1), points of cell c are points[offsets[c]:offsets[c + 1]]
+        """
+        if np.array_equal(self.index.ravel(), np.arange(self.nsegments)):
+            return self.points, self.offsets
+        offsets = np.zeros(self.index.size + 1, dtype=np.int64)
+        np.cumsum(self.counts.ravel(), out=offsets[1:])
+        return self.select(), offsets
+
+    def to_dense(self, fill=np.nan):
+        """
+        Return the diagrams as a padded array, shape=(*cell_shape, max_npoints, 2).
+        """
+        npoints = max(self.max_npoints, 1)
+        dense = np.full((self.index.size, npoints, 2), fill, dtype=np.float64)
+        index = self.index.ravel()
+        cells = np.nonzero(index >= 0)[0]
+        segs = index[cells]
+        counts = self.segment_counts[segs]
+        rows = np.repeat(cells, counts)
+        cols = _ranges(np.zeros_like(counts), counts)
+        dense[rows, cols] = self.points[_ranges(self.offsets[segs], counts)]
+        return dense.reshape(self.cell_shape + (npoints, 2))
+
+
+class LazyRaggedPD(RaggedPD):
+    """
+    RaggedPD whose points stay in an HDF5 file until they are used.
+
+    offsets and index are read when it is created, the points of a cell or
+    of a selection of cells are read from the file by __getitem__ and
+    select(). Accessing points reads (and keeps) all of them.
+
+    Usage:
+        with h5py.File("result.h5", "r") as f:
+            diagrams = RaggedPD.read(f["threading"], lazy=True)
+            row = diagrams.select(3)  # passive chain 3 だけを読む
+    """
+
+    def __init__(self, dataset, offsets, index):
+        """
+        args:
+            dataset: h5py.Dataset, shape=(npoints, 2)
+            offsets: np.array, positions of the segments in dataset.
+                They may start after 0 when dataset holds several containers
+                (e.g. the frames of a TrajectoryFile).
+            index: np.array, segment of each cell
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        self._dataset = dataset
+        self._base = int(offsets[0])
+        self._points = None
+        self.offsets = offsets - self._base
+        self.index = np.asarray(index, dtype=np.int64)
+        self.nread = 0  # ファイルから読んだ点の数
+
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = self._read(0, self.offsets[-1])
+        return self._points
+
+    def _read(self, start, stop):
+        self.nread += stop - start
+        return np.asarray(self._dataset[self._base + start : self._base + stop], dtype=np.float64).reshape(-1, 2)
+
+    def __getitem__(self, cell):
+        if self._points is not None:
+            return super().__getitem__(cell)
+        s = self.index[cell]
+        if s < 0:
+            return np.empty((0, 2))
+        return self._read(self.offsets[s], self.offsets[s + 1])
+
+    def select(self, cells=Ellipsis):
+        if self._points is not None:
+            return super().select(cells)
+        segs = np.atleast_1d(self.index[cells]).ravel()
+        segs = segs[segs >= 0]
+        starts = self.offsets[segs]
+        stops = self.offsets[segs + 1]
+        keep = stops > starts
+        starts, stops = starts[keep], stops[keep]
+        if len(starts) == 0:
+            return np.empty((0, 2))
+        # 連続するセグメントはまとめて 1 回で読む
+        breaks = np.nonzero(starts[1:] != stops[:-1])[0] + 1
+        run_starts = starts[np.concatenate([[0], breaks])]
+        run_stops = stops[np.concatenate([breaks - 1, [len(stops) - 1]])]
+        return np.concatenate([self._read(a, b) for a, b in zip(run_starts, run_stops)])
+
+    def load(self):
+        """Read all points, return a plain RaggedPD."""
+        return RaggedPD(self.points, self.offsets, self.index)
+
+
+def filter_options(compression="gzip", compression_opts=4, shuffle=True):
+    """
+    Keyword arguments of h5py create_dataset for a compression filter.
+
+    args:
+        compression: str, "gzip", "lzf" or None
+        compression_opts: int, gzip level (ignored for the other filters)
+        shuffle: bool, apply the shuffle filter before compression
+    """
+    if compression is None:
+        return {}
+    options = {"compression": compression, "shuffle": shuffle}
+    if compression == "gzip":
+        options["compression_opts"] = compression_opts
+    return options
+
+
+def as_ragged(pd):
+    """
+    Return pd as a RaggedPD, converting NaN-padded arrays.
+    """
+    if pd is None or isinstance(pd, RaggedPD):
+        return pd
+    return RaggedPD.from_dense(pd)
+
+
+def _ranges(starts, counts):
+    """
+    Concatenate np.arange(s, s + n) for every (s, n) of (starts, counts).
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    nonempty = counts > 0
+    starts, counts = starts[nonempty], counts[nonempty]
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    # 差分を累積和する: 区間の先頭では前の区間の末尾から次の開始位置へ跳ぶ
+    steps = np.ones(total, dtype=np.int64)
+    steps[0] = starts[0]
+    heads = np.cumsum(counts)[:-1]
+    steps[heads] = starts[1:] - (starts[:-1] + counts[:-1]) + 1
+    return np.cumsum(steps)
@@ -0,0 +1,247 @@
+"""
+Streaming ensemble statistics of Betti curves.
+
+ベッティ数の曲線は点毎の寄与の和なので，PD を passive chain の塊ごとにファイルから読んで
+曲線に足し込めば，全体を一度にメモリに載せる必要はない．
+フレーム毎の曲線の平均と分散は Welford のアルゴリズムで逐次更新し，
+ファイル毎に別のプロセスで集計した結果は最後にまとめる (merge)．
+"""
+
+import numpy as np
+
+from .main import HomologicalThreading, betti_curve, compute_betti_number, pad_rows
+from .parallel import WorkerPool
+from .resources import ResourcePlanner, limit_threads, pin_threads
+from .trajectory import TrajectoryFile, is_trajectory
+
+# 集計する PD
+KINDS = ("pd_i", "pd_i_cup_j", "threading")
+
+
+class RunningStats:
+    """
+    Running mean and variance of fixed-length curves (Welford's algorithm).
+
+    Attributes:
+        count: int, number of curves added
+        mean: np.array, shape=(n)
+        m2: np.array, shape=(n), sum of squared deviations from the mean
+    """
+
+    def __init__(self, n):
+        self.count = 0
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        """
+        Combine with the statistics of another set of curves (Chan et al.).
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta**2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+        """Unbiased variance, NaN for less than 2 curves."""
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def sem(self):
+        """Standard error of the mean."""
+        return self.std / np.sqrt(max(self.count, 1))
+
+
+class EnsembleBetti:
+    """
+    Mean and variance of the Betti curves of PD_i, PD_i_cup_j and Threading
+    over many frames.
+
+    Each frame is read lazily and its curves are accumulated over blocks of
+    chunk_size passive chains, so at most one block of diagrams is in memory
+    at a time, however many chains or files there are. The curve of a frame
+    is the same as the betti() methods of the compute classes give.
+
+    Usage:
+        ensemble = EnsembleBetti(alphas=0.1 * np.arange(501))
+        ensemble.run(files, num_processes=8)
+        mean, std = ensemble.stats["threading"].mean, ensemble.stats["threading"].std
+
+    Attributes:
+        alphas: np.array, alpha grid of the curves
+        chains: np.array of int, chains used (None for all)
+        chunk_size: int, number of passive chains read at once
+        stats: dict, RunningStats of each of KINDS
+    """
+
+    def __init__(self, alphas, chains=None, chunk_size=64, threshold=1e-10):
+        self.alphas = np.asarray(alphas, dtype=np.float64)
+        self.chains = None if chains is None else np.asarray(chains, dtype=np.int64)
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self.stats = {kind: RunningStats(len(self.alphas)) for kind in KINDS}
+
+    @property
+    def count(self):
+        return max(stats.count for stats in self.stats.values())
+
+    def add(self, pds):
+        """
+        Add the curves of one frame (a HomologicalThreading, possibly read lazily).
+        """
+        if pds.pd_i.diagrams is not None:
+            self.stats["pd_i"].add(self._curve_pd_i(pds.pd_i.diagrams))
+        if pds.pd_i_cup_j.diagrams is not None:
+            self.stats["pd_i_cup_j"].add(self._curve_pairs(pds.pd_i_cup_j.diagrams))
+        if pds.threading.diagrams is not None:
+            self.stats["threading"].add(self._curve_threading(pds.threading.diagrams))
+
+    def add_file(self, filename, start=0, stop=None, step=1):
+        """
+        Add every frame of a result file (single or multi-frame).
+        start, stop and step select the frames of a multi-frame file.
+        """
+        pds = HomologicalThreading()
+        if is_trajectory(filename):
+            for _ in pds.iter_hdf5(filename, start, stop, step, lazy=True):
+                self.add(pds)
+            return
+        pds.from_hdf5(filename, lazy=True)
+        try:
+            self.add(pds)
+        finally:
+            pds.close()
+
+    def merge(self, other):
+        """Combine with the statistics of another EnsembleBetti of the same alpha grid."""
+        if not np.array_equal(self.alphas, other.alphas):
+            raise ValueError("Cannot merge ensembles with different alpha grids")
+        for kind in KINDS:
+            self.stats[kind].merge(other.stats[kind])
+        return self
+
+    def run(self, filenames, num_processes=None, pool=None, resources=None):
+        """
+        Add all frames of several files, in parallel over the files.
+
+        Every worker accumulates its own EnsembleBetti, which are merged in
+        the order of the files. Multi-frame files are split into about one
+        task per worker.
+
+        args:
+            filenames: list of str
+            num_processes: int, number of worker processes (1: serial)
+            pool: executor (WorkerPool, ThreadExecutor, ...) to use instead of starting a WorkerPool
+            resources: ResourcePlanner, core budget split between the workers and their OpenMP threads
+        """
+        if resources is None:
+            resources = ResourcePlanner()
+        own_pool = pool is None and num_processes != 1
+        if own_pool:
+            pool = WorkerPool(resources.cores if num_processes is None else num_processes)
+        try:
+            nworkers = 1 if pool is None else pool.num_workers
+            tasks = []
+            for filename in filenames:
+                if is_trajectory(filename):
+                    with TrajectoryFile(filename, "r") as traj:
+                        nframes = len(traj)
+                    bounds = np.linspace(0, nframes, min(nworkers, max(nframes, 1)) + 1).astype(int)
+                    tasks += [(filename, a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+                else:
+                    tasks.append((filename, 0, None))
+            config = (self.alphas, self.chains, self.chunk_size, self.threshold)
+            plan = resources.plan("ensemble", nworkers, len(tasks))
+            # ベッティ数の OpenMP のスレッド数: プロセスのワーカーはタスクの最初に固定し，それ以外は親で制限する
+            threads = plan.threads if getattr(pool, "name", None) == "process" else None
+            tasks = [(config, threads) + task for task in tasks]
+            with limit_threads(plan.threads):
+                if pool is None:
+                    results = map(_ensemble_worker, tasks)
+                else:
+                    results = pool.map(_ensemble_worker, tasks)
+                for result in results:
+                    self.merge(result)
+        finally:
+            if own_pool:
+                pool.close()
+        return self
+
+    def summary(self):
+        """
+        return:
+            summary: dict, "<kind>_mean", "<kind>_std", "<kind>_sem" (np.array) and
+                "<kind>_count" (int) of each kind, plus "alphas"
+        """
+        summary = {"alphas": self.alphas}
+        for kind, stats in self.stats.items():
+            summary[f"{kind}_mean"] = stats.mean
+            summary[f"{kind}_std"] = stats.std
+            summary[f"{kind}_sem"] = stats.sem
+            summary[f"{kind}_count"] = stats.count
+        return summary
+
+    def _blocks(self, nchains):
+        chains = np.arange(nchains) if self.chains is None else self.chains
+        for start in range(0, len(chains), self.chunk_size):
+            yield chains[start : start + self.chunk_size]
+
+    def _curve_pd_i(self, diagrams):
+        curve = np.zeros(len(self.alphas))
+        for block in self._blocks(diagrams.cell_shape[0]):
+            curve += betti_curve(diagrams.select(block), self.alphas)
+        return curve
+
+    def _curve_pairs(self, diagrams):
+        nchains = diagrams.cell_shape[0]
+        selected = np.zeros(nchains, dtype=bool)
+        selected[np.arange(nchains) if self.chains is None else self.chains] = True
+        curve = np.zeros(len(self.alphas))
+        for block in self._blocks(nchains):
+            # 各ペア (i < j) を 1 回ずつ数える
+            rows, cols = np.nonzero((np.arange(nchains)[None, :] > block[:, None]) & selected[None, :])
+            curve += betti_curve(diagrams.select((block[rows], cols)), self.alphas)
+        return curve
+
+    def _curve_threading(self, diagrams):
+        chains = np.arange(diagrams.cell_shape[0]) if self.chains is None else self.chains
+        curve = np.zeros(len(self.alphas))
+        for block in self._blocks(diagrams.cell_shape[0]):
+            # 塊の点を 1 回で読んでから passive chain 毎に分ける
+            counts = np.atleast_2d(diagrams.counts[block]).sum(axis=1)
+            rows = np.split(diagrams.select(block), np.cumsum(counts)[:-1])
+            _, betti = compute_betti_number(
+                pad_rows(rows), is_threading=True, threshold=self.threshold, alphas=self.alphas
+            )
+            # compute_betti_number は passive chain の数で割るので，点の数に戻してから全体の数で割る
+            curve += np.rint(betti * len(block))
+        return curve / max(len(chains), 1)
+
+
+def _ensemble_worker(args):
+    config, threads, filename, start, stop = args
+    pin_threads(threads)
+    ensemble = EnsembleBetti(*config)
+    ensemble.add_file(filename, start, stop)
+    return ensemble
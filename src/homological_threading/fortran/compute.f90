@@ -5,152 +5,271 @@ module compute
 
 contains
 
-    subroutine threading(pd_i, pd_i_cup_j, threading_flags, threading_pd, threshold)
+    ! homological threading の判定
+    ! PD は全点を 1 つの配列に詰め，offsets (0 始まり) で区切って渡す (CSR 形式)
+    ! 引数の型と並びは RaggedPD の配列 (float64 の points.T, int64 の offsets と index.T) と同じなので，
+    ! f2py はコピーせずにそのまま渡す．logical(1) の出力は NumPy の int8 (bool として view できる)
+    subroutine threading_ragged(pd_i, offsets_i, pd_cup, offsets_cup, index_cup, threshold, keep, threading_flags, counts)
         implicit none
-         
-        double precision, intent(in) :: pd_i(:, :, :) ! shape: (2, npoints, nchains)
-        double precision, intent(in) :: pd_i_cup_j(:, :, :, :) ! shape: (2, npoints2, nchains_a, nchains_p)
-        logical, intent(inout) :: threading_flags(:, :) ! shape: (nchains, nchains)
-        double precision, intent(inout) :: threading_pd(:, :, :, :) ! shape: (2, npoints, nchains_a, nchains_p)
-        double precision, intent(in) :: threshold
 
-        integer :: nchains, npoints, npoints2, i, j, k, l
-        integer :: n
-        logical, allocatable :: flags(:) ! shape: (npoitns)
+        double precision, intent(in) :: pd_i(:, :) ! shape: (2, total_points_i)
+        integer(kind=8), intent(in) :: offsets_i(:) ! shape: (nchains + 1)
+        double precision, intent(in) :: pd_cup(:, :) ! shape: (2, total_points_cup)
+        integer(kind=8), intent(in) :: offsets_cup(:) ! shape: (nsegments + 1)
+        integer(kind=8), intent(in) :: index_cup(:, :) ! shape: (active, passive), セグメント番号 (0 始まり), -1 なら空
+        double precision, intent(in) :: threshold
+        ! keep(k, j): passive chain の点 k が active chain j との PD_i_cup_j に残っていない (threading されている)
+        logical(kind=1), dimension(size(pd_i, 2), size(index_cup, 1)), intent(out) :: keep ! shape: (total_points_i, active)
+        logical(kind=1), dimension(size(index_cup, 1), size(index_cup, 2)), intent(out) :: threading_flags ! shape: (active, passive)
+        ! counts(j, i): keep が true の passive chain i の点の数 (threading_points の出力の大きさ)
+        integer(kind=8), dimension(size(index_cup, 1), size(index_cup, 2)), intent(out) :: counts ! shape: (active, passive)
+
+        integer :: nchains, i, j
+        integer(kind=8) :: k, l, s
         double precision :: diff(2)
-        double precision :: target_point(2)
 
-        nchains = size(pd_i, 3)
-        npoints = size(pd_i, 2)
-        npoints2 = size(pd_i_cup_j, 2)
+        nchains = size(index_cup, 2)
 
+        keep = .false.
         threading_flags = .false.
-        threading_pd = -1d0 ! PD は 0 以上の値なので，-1 で初期化
+        counts = 0
 
-        !$omp parallel do private(i, j, k, l, n, diff, flags, target_point) shared(pd_i, pd_i_cup_j, threading_flags, threading_pd)
+        !$omp parallel do private(i, j, k, l, s, diff) &
+        !$omp& shared(pd_i, offsets_i, pd_cup, offsets_cup, index_cup, keep, threading_flags, counts)
         loop_passive_chain: do i = 1, nchains
 
-            loop_active_chain: do j = 1, nchains
+            loop_active_chain: do j = 1, size(index_cup, 1)
                 if (i == j) cycle ! 次の j へ
-                allocate(flags(npoints))
-                flags = .true. ! 各点がthreading されているかどうかのフラグ， True で初期化
-
-                loop_passive_point: do k = 1, npoints 
-                    ! NaN なら，それ以降の要素も NaN なので，計算しない
-                    if (ieee_is_nan(pd_i(1, k, i)) .or. ieee_is_nan(pd_i(2, k, i))) then
-                        flags(k:npoints) = .false.
-                        exit loop_passive_point
-                    end if
-                    target_point = pd_i(:, k, i)
+                s = index_cup(j, i)
 
-                    loop_active_point: do l = 1, npoints2 
-                        ! NaN なら，それ以降の要素も NaN なので，計算しない
-                        if (ieee_is_nan(pd_i_cup_j(1, l, j, i)) .or. ieee_is_nan(pd_i_cup_j(2, l, j, i))) exit loop_active_point
+                loop_passive_point: do k = offsets_i(i) + 1, offsets_i(i + 1)
+                    keep(k, j) = .true.
+                    if (s < 0) cycle loop_passive_point
+
+                    loop_active_point: do l = offsets_cup(s + 1) + 1, offsets_cup(s + 2)
                         ! 点の距離が threshold 以下なら，同じ点とみなす → threading されていないループ
-                        diff(:) = target_point(:) - pd_i_cup_j(:, l, j, i)
+                        diff(:) = pd_i(:, k) - pd_cup(:, l)
                         if (all(abs(diff) < threshold)) then
-                            flags(k) = .false.
+                            keep(k, j) = .false.
                             exit loop_active_point
                         end if
                     end do loop_active_point
-                    
-                end do loop_passive_point
 
-                ! flag が True の点を threading_pd に格納
-                n = 0
-                loop_threading_point: do k = 1, npoints
-                    if (flags(k)) then
-                        n = n + 1
-                        threading_pd(:, n, j, i) = pd_i(:, k, i)
-                    end if
-                end do loop_threading_point
+                end do loop_passive_point
 
                 ! 1つでも true があれば，threading されている
-                if (any(flags)) then
-                    threading_flags(j, i) = .true.
-                end if
-                deallocate(flags)
+                counts(j, i) = count(keep(offsets_i(i) + 1:offsets_i(i + 1), j))
+                threading_flags(j, i) = counts(j, i) > 0
             end do loop_active_chain
 
         end do loop_passive_chain
         !$omp end parallel do
 
-    end subroutine threading
+    end subroutine threading_ragged
 
-    subroutine betti_number(pd, d_alpha, n_alpha, betti)
+    ! threading_ragged と同じ結果を，passive chain の点を birth の順に並べて二分探索で求める (matching.py の threading_sorted, method="sorted")
+    ! PD_i_cup_j の各点は birth が近い PD_i の点だけと比べるので，セル毎の計算量は点の数の積ではなく
+    ! (PD_i_cup_j の点の数) * log(PD_i の点の数) になる
+    subroutine threading_sorted(pd_i, offsets_i, order_i, pd_cup, offsets_cup, index_cup, threshold, keep, threading_flags, counts)
         implicit none
 
-        double precision, intent(in) :: pd(:, :) ! shape: (2, npoints)
-        double precision, intent(in) :: d_alpha
-        integer, intent(in) :: n_alpha
-        double precision, dimension(n_alpha), intent(out) :: betti ! return value
-        integer(kind=8), dimension(n_alpha) :: betti_int
+        double precision, intent(in) :: pd_i(:, :) ! shape: (2, total_points_i)
+        integer(kind=8), intent(in) :: offsets_i(:) ! shape: (nchains + 1)
+        ! order_i: passive chain 毎に birth の昇順に並べた点の番号 (0 始まり, chain i の範囲の中で並べ替えたもの)
+        integer(kind=8), intent(in) :: order_i(:) ! shape: (total_points_i)
+        double precision, intent(in) :: pd_cup(:, :) ! shape: (2, total_points_cup)
+        integer(kind=8), intent(in) :: offsets_cup(:) ! shape: (nsegments + 1)
+        integer(kind=8), intent(in) :: index_cup(:, :) ! shape: (active, passive)
+        double precision, intent(in) :: threshold
+        logical(kind=1), dimension(size(pd_i, 2), size(index_cup, 1)), intent(out) :: keep ! shape: (total_points_i, active)
+        logical(kind=1), dimension(size(index_cup, 1), size(index_cup, 2)), intent(out) :: threading_flags ! shape: (active, passive)
+        integer(kind=8), dimension(size(index_cup, 1), size(index_cup, 2)), intent(out) :: counts ! shape: (active, passive)
 
-        integer :: npoints, i, j
-        double precision :: alpha
+        integer :: nchains, i, j
+        integer(kind=8) :: start, n, k, l, s, lo, hi, mid
+        double precision :: lower, upper
+        double precision, allocatable :: births(:)
 
-        npoints = size(pd, 2)
-        betti = 0   
-        betti_int = 0
-        !$omp parallel do private(i, j, alpha) shared(pd, betti)
-        do i = 1, n_alpha
-            alpha = d_alpha * (i - 1)
-            do j = 1, npoints
-                ! 既に生まれていて， まだ死んでない点の数を数える
-                if (pd(1, j) <= alpha .and. pd(2, j) >= alpha) then
-                    betti_int(i) = betti_int(i) + 1
+        nchains = size(index_cup, 2)
+
+        keep = .false.
+        threading_flags = .false.
+        counts = 0
+
+        !$omp parallel do private(i, j, start, n, k, l, s, lo, hi, mid, lower, upper, births) schedule(dynamic) &
+        !$omp& shared(pd_i, offsets_i, order_i, pd_cup, offsets_cup, index_cup, keep, threading_flags, counts)
+        loop_passive_chain: do i = 1, nchains
+            start = offsets_i(i)
+            n = offsets_i(i + 1) - start
+            allocate(births(n))
+            births(:) = pd_i(1, order_i(start + 1:start + n) + 1)
+
+            loop_active_chain: do j = 1, size(index_cup, 1)
+                if (i == j) cycle
+                keep(start + 1:start + n, j) = .true.
+                s = index_cup(j, i)
+
+                if (s >= 0) then
+                    loop_active_point: do l = offsets_cup(s + 1) + 1, offsets_cup(s + 2)
+                        ! birth の差が threshold 未満になりうる範囲 (丸めの分だけ広く取り，判定は threading_ragged と同じ式)
+                        lower = pd_cup(1, l) - 2.0d0 * threshold
+                        upper = pd_cup(1, l) + 2.0d0 * threshold
+                        ! births(lo) >= lower となる最初の lo
+                        lo = 1
+                        hi = n + 1
+                        do while (lo < hi)
+                            mid = (lo + hi) / 2
+                            if (births(mid) < lower) then
+                                lo = mid + 1
+                            else
+                                hi = mid
+                            end if
+                        end do
+                        do while (lo <= n)
+                            if (births(lo) > upper) exit
+                            k = order_i(start + lo) + 1
+                            if (all(abs(pd_i(:, k) - pd_cup(:, l)) < threshold)) keep(k, j) = .false.
+                            lo = lo + 1
+                        end do
+                    end do loop_active_point
                 end if
-            end do
-        end do
+
+                counts(j, i) = count(keep(start + 1:start + n, j))
+                threading_flags(j, i) = counts(j, i) > 0
+            end do loop_active_chain
+
+            deallocate(births)
+        end do loop_passive_chain
         !$omp end parallel do
-        do i = 1, n_alpha
-            betti(i) = dble(betti_int(i))
-        end do
-    end subroutine betti_number
 
-    subroutine betti_number_threading(pd, d_alpha, n_alpha, threshold, betti)
+    end subroutine threading_sorted
+
+    ! keep が true の点を (passive, active) のセルの順に，呼び出し側が確保した points_out に詰める
+    ! offsets_out は threading_ragged の counts を (passive, active) の順に累積したもの (0 始まり)
+    subroutine threading_points(pd_i, offsets_i, keep, offsets_out, points_out)
         implicit none
 
-        double precision, intent(in) :: pd(:, :, :, :) ! shape: (2, npoints, active, passive)
-        double precision, intent(in) :: d_alpha
-        integer, intent(in) :: n_alpha
-        double precision, intent(in) :: threshold
-        double precision, dimension(n_alpha), intent(out) :: betti
+        double precision, intent(in) :: pd_i(:, :) ! shape: (2, total_points_i)
+        integer(kind=8), intent(in) :: offsets_i(:) ! shape: (nchains + 1)
+        logical(kind=1), intent(in) :: keep(:, :) ! shape: (total_points_i, active)
+        integer(kind=8), intent(in) :: offsets_out(:) ! shape: (passive * active + 1)
+        double precision, intent(inout) :: points_out(:, :) ! shape: (2, total_points_out)
 
-        integer(kind=8), dimension(n_alpha) :: betti_int
-        double precision, allocatable :: unique_pd(:,:)
+        integer :: i, j, nactive
+        integer(kind=8) :: k, n
 
-        integer :: nchains, npoints, i, j, k, m
-        integer :: total_points
-        integer :: n_unique
-        double precision :: alpha
+        nactive = size(keep, 2)
 
+        !$omp parallel do private(i, j, k, n) shared(pd_i, offsets_i, keep, offsets_out, points_out)
+        do i = 1, size(offsets_i) - 1 ! passive
+            do j = 1, nactive
+                n = offsets_out((i - 1) * nactive + j)
+                do k = offsets_i(i) + 1, offsets_i(i + 1)
+                    if (keep(k, j)) then
+                        n = n + 1
+                        points_out(:, n) = pd_i(:, k)
+                    end if
+                end do
+            end do
+        end do
+        !$omp end parallel do
 
-        nchains = size(pd, 3)
-        npoints = size(pd, 2)
-        total_points = nchains * npoints
-        betti = 0
-        betti_int = 0
-        !$omp parallel private(i, j, k, alpha, unique_pd, n_unique) shared(pd, betti, betti_int, threshold)
-        allocate(unique_pd(2, total_points))
-        !$omp do
-        do i = 1, n_alpha
-            alpha = d_alpha * (i - 1)
-            do j = 1, nchains ! passive
-                call unique_points(pd(:, :, :, j), threshold, unique_pd)
-                n_unique = size(unique_pd, 2)
-                do k = 1, n_unique
-                    if (unique_pd(1, k) < 0.0d0) cycle
-                    if (unique_pd(1, k) <= alpha .and. unique_pd(2, k) >= alpha) then
-                        betti_int(i) = betti_int(i) + 1
+    end subroutine threading_points
+
+    ! 三角形の境界行列を Z/2 係数で簡約し，1 次のパーシステンス対を求める (alpha.py の builtin エンジン)
+    ! 辺と三角形はどちらもフィルトレーション順に並べた番号 (1 始まり) で渡す
+    subroutine h1_reduction(tri_edges, n_edges, low)
+        implicit none
+
+        integer, intent(in) :: tri_edges(:, :) ! shape: (3, ntriangles), 各三角形の 3 辺の番号
+        integer, intent(in) :: n_edges
+        ! low(j): 三角形 j と対になる (j で消える 1 次の輪を生んだ) 辺の番号，0 なら対は無い
+        integer, dimension(size(tri_edges, 2)), intent(out) :: low
+
+        integer, allocatable :: pivot(:) ! pivot(e): 簡約後の最下行が e の列 (三角形の番号), 0 なら無し
+        integer, allocatable :: start(:), length(:) ! 簡約後の列の cols の中の位置
+        integer, allocatable :: cols(:), tmp(:), work(:)
+        logical, allocatable :: mark(:)
+        integer :: ntri, j, k, e, nw, n, l, used
+
+        ntri = size(tri_edges, 2)
+        allocate(pivot(n_edges), mark(n_edges), start(ntri), length(ntri))
+        allocate(cols(max(4 * ntri, 16)), work(max(n_edges, 3)))
+        pivot = 0
+        mark = .false.
+        length = 0
+        used = 0
+        low = 0
+
+        do j = 1, ntri
+            ! work(1:nw) に現在の列の要素 (mark が true の辺) を持つ
+            nw = 3
+            work(1:3) = tri_edges(:, j)
+            mark(work(1:3)) = .true.
+            do
+                ! 消えた要素を詰めて，最下行 (番号が最大の辺) を探す
+                n = 0
+                l = 0
+                do k = 1, nw
+                    if (mark(work(k))) then
+                        n = n + 1
+                        work(n) = work(k)
+                        l = max(l, work(k))
                     end if
                 end do
+                nw = n
+                if (nw == 0) exit ! 零列: j は 2 次の輪を生む
+                if (pivot(l) == 0) then
+                    ! 最下行が他の列と重ならないので簡約済み: (辺 l, 三角形 j) が対
+                    pivot(l) = j
+                    low(j) = l
+                    if (used + nw > size(cols)) then
+                        allocate(tmp(2 * (used + nw)))
+                        tmp(1:used) = cols(1:used)
+                        call move_alloc(tmp, cols)
+                    end if
+                    start(j) = used
+                    length(j) = nw
+                    cols(used + 1:used + nw) = work(1:nw)
+                    used = used + nw
+                    exit
+                end if
+                ! 最下行が同じ列を足す (Z/2 なので要素の有無を反転する)
+                do k = start(pivot(l)) + 1, start(pivot(l)) + length(pivot(l))
+                    e = cols(k)
+                    if (.not. mark(e)) then
+                        nw = nw + 1
+                        work(nw) = e
+                    end if
+                    mark(e) = .not. mark(e)
+                end do
             end do
-            betti(i) = dble(betti_int(i)) / dble(nchains)
+            mark(work(1:nw)) = .false.
         end do
-        !$omp end do
-        !$omp end parallel 
-    end subroutine betti_number_threading
+
+        deallocate(pivot, mark, start, length, cols, work)
+    end subroutine h1_reduction
+
+    ! passive chain ごとに threading の PD の重複を除いた点を返す
+    ! 重複除去は alpha のループの外で 1 回だけ行う
+    subroutine unique_threading_points(pd, threshold, unique_pd, n_unique)
+        implicit none
+
+        double precision, intent(in) :: pd(:, :, :, :) ! shape: (2, npoints, active, passive)
+        double precision, intent(in) :: threshold
+        ! unique_pd(:, 1:n_unique(j), j) が passive chain j の重複を除いた点
+        double precision, dimension(2, size(pd, 2) * size(pd, 3), size(pd, 4)), intent(out) :: unique_pd
+        integer, dimension(size(pd, 4)), intent(out) :: n_unique
+
+        integer :: j
+
+        !$omp parallel do private(j) shared(pd, threshold, unique_pd, n_unique)
+        do j = 1, size(pd, 4) ! passive
+            call unique_points(pd(:, :, :, j), threshold, unique_pd(:, :, j))
+            n_unique(j) = count(unique_pd(1, :, j) >= 0.0d0)
+        end do
+        !$omp end parallel do
+    end subroutine unique_threading_points
 
     ! 重複した要素を除いた配列を返す
     subroutine unique_points(pd, threshold, unique_array)
@@ -213,7 +332,7 @@ contains
     subroutine compute_num_threadings(threading_flags, n_a, n_p)
         implicit none
 
-        logical, intent(in) :: threading_flags(:,:) ! shape: (active, passive)
+        logical(kind=1), intent(in) :: threading_flags(:,:) ! shape: (active, passive), Threading.flags を int8 として view したもの
         integer, dimension(size(threading_flags, 1)), intent(out) :: n_a, n_p ! return value
 
         integer :: i, j
@@ -230,6 +349,26 @@ contains
         end do
 
     end subroutine compute_num_threadings
+
+    ! このモジュールの OpenMP の並列区間で使うスレッド数 (resources.py の ResourcePlanner が段階毎に設定する)
+    subroutine set_num_threads(n)
+        implicit none
+
+        integer, intent(in) :: n
+
+        call omp_set_num_threads(max(n, 1))
+
+    end subroutine set_num_threads
+
+    ! 次の並列区間で使われるスレッド数
+    subroutine max_threads(n)
+        implicit none
+
+        integer, intent(out) :: n
+
+        n = omp_get_max_threads()
+
+    end subroutine max_threads
     !subroutine shrink_array(array, n_new)
     !    implicit none
     !
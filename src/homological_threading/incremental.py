@@ -0,0 +1,152 @@
+"""
+Reuse of diagrams between consecutive frames.
+
+連続するスナップショットではほとんどのチェインがあまり動かないので，
+前回計算した時からの変位が許容値以下のチェインについては PD_i を，
+両方のチェインが許容値以下のペアについては PD_i_cup_j を再利用する．
+"""
+
+import numpy as np
+
+
+class FrameCache:
+    """
+    Diagrams of the previous frames, shared by the HomologicalThreading of each frame.
+
+    Each chain remembers the coordinates at which its PD_i was last computed.
+    A chain is stale when its beads have moved more than tolerance since then,
+    measured as the largest bead displacement (metric="max") or the RMSD of the
+    beads (metric="rmsd"). PD_i of stale chains and PD_i_cup_j of pairs with a
+    stale chain are recomputed; everything else is taken from the cache.
+    Diagrams are only reused by a call with the same options (dim and engine
+    for PD_i; dim, cutoff, prescreen and engine for PD_i_cup_j), otherwise
+    they are computed again and replace the cached ones.
+
+    Usage:
+        cache = FrameCache(tolerance=0.05)
+        for coords in frames:
+            pds = HomologicalThreading(cache=cache)
+            pds.pd_i.compute(coords)
+            pds.pd_i_cup_j.compute(coords)
+            print(pds.metadata["cache_hit_rate_pd_i"], pds.metadata["cache_hit_rate_pd_i_cup_j"])
+
+    Attributes:
+        tolerance: float, displacement below which a chain is reused
+        metric: str, "max" or "rmsd"
+        stale: np.array of bool, shape=(nchains), chains recomputed in the current frame
+        history: list of dict, hit rates of PD_i and PD_i_cup_j of each frame
+    """
+
+    def __init__(self, tolerance, metric="max"):
+        if metric not in ("max", "rmsd"):
+            raise ValueError(f"Unknown metric: {metric}")
+        self.tolerance = tolerance
+        self.metric = metric
+        self.reference = None  # shape: (nchains, nbeads, 3), 最後に計算した時の座標
+        self.dim = None
+        self.pd_i = None  # チェイン毎の PD のリスト
+        self.pd_pairs = None  # ペア (i < j) 毎の PD のリスト
+        self.pd_i_options = None  # pd_i を計算した時の (dim, engine)
+        self.pair_options = None  # pd_pairs を計算した時の (dim, cutoff, prescreen, engine)
+        self.stale = None
+        self.history = []
+        self._frame = None  # 現在のフレームの座標
+
+    def displacement(self, coords):
+        """
+        Displacement of each chain since its PD_i was last computed, shape=(nchains).
+        """
+        disp = np.linalg.norm(coords - self.reference, axis=2)
+        if self.metric == "max":
+            return disp.max(axis=1)
+        return np.sqrt((disp**2).mean(axis=1))
+
+    def begin_frame(self, coords, dim=1):
+        """
+        Decide which chains are stale in the frame of coords.
+        Calling it again with the same coordinates returns the same chains,
+        so PD_i and PD_i_cup_j of one frame agree.
+
+        return:
+            stale: np.array of bool, shape=(nchains)
+        """
+        if self._frame is not None and self._frame.shape == coords.shape and np.array_equal(self._frame, coords):
+            return self.stale
+        if self.reference is None or self.reference.shape != coords.shape or self.dim != dim:
+            # 最初のフレーム，または系が変わった: 全て計算し直す
+            self.reference = np.array(coords, dtype=np.float64)
+            self.dim = dim
+            self.pd_i = [None] * coords.shape[0]
+            self.pd_pairs = None
+            self.stale = np.ones(coords.shape[0], dtype=bool)
+        else:
+            self.stale = self.displacement(coords) > self.tolerance
+            self.reference[self.stale] = coords[self.stale]
+        self._frame = np.array(coords, dtype=np.float64)
+        self.history.append({"pd_i": None, "pd_i_cup_j": None})
+        return self.stale
+
+    def fill_pd_i(self, pd_list, options=None):
+        """
+        Put the cached PD_i of the chains that are not stale into pd_list (in place).
+
+        args:
+            pd_list: list, PD_i of each chain (None: not computed yet)
+            options: tuple, (dim, engine) of the call, nothing is reused if it differs from the cached one
+
+        return:
+            nhits: int, number of chains taken from the cache
+        """
+        nhits = 0
+        if options != self.pd_i_options:
+            return nhits
+        for i in np.nonzero(~self.stale)[0]:
+            if self.pd_i[i] is not None:
+                pd_list[i] = self.pd_i[i]
+                nhits += 1
+        return nhits
+
+    def store_pd_i(self, pd_list, nhits, options=None):
+        """
+        Keep PD_i of the current frame computed with options (see fill_pd_i), return the hit rate.
+        """
+        self.pd_i = list(pd_list)
+        self.pd_i_options = options
+        hit_rate = nhits / len(pd_list) if len(pd_list) > 0 else 1.0
+        self.history[-1]["pd_i"] = hit_rate
+        return hit_rate
+
+    def fill_pairs(self, pd_pairs, pairs, options=None):
+        """
+        Put the cached PD_i_cup_j of the pairs without a stale chain into pd_pairs (in place).
+        Entries that are already filled (e.g. by the prescreen) are kept.
+
+        args:
+            pd_pairs: list, PD_i_cup_j of each pair (None: not computed yet)
+            pairs: np.array, shape=(npairs, 2)
+            options: tuple, (dim, cutoff, prescreen, engine) of the call. The cached pairs
+                (including the entries pruned by the prescreen) are only reused with the same options.
+
+        return:
+            nhits: int, number of pairs taken from the cache
+        """
+        nhits = 0
+        if self.pd_pairs is None or len(self.pd_pairs) != len(pairs) or options != self.pair_options:
+            return nhits
+        fresh = ~self.stale[pairs[:, 0]] & ~self.stale[pairs[:, 1]]
+        for k in np.nonzero(fresh)[0]:
+            if pd_pairs[k] is None and self.pd_pairs[k] is not None:
+                pd_pairs[k] = self.pd_pairs[k]
+                nhits += 1
+        return nhits
+
+    def store_pairs(self, pd_pairs, nhits, nneeded, options=None):
+        """
+        Keep PD_i_cup_j of the current frame computed with options (see fill_pairs), return the hit rate
+        (pairs taken from the cache / pairs that needed an alpha filtration).
+        """
+        self.pd_pairs = list(pd_pairs)
+        self.pair_options = options
+        hit_rate = nhits / nneeded if nneeded > 0 else 1.0
+        self.history[-1]["pd_i_cup_j"] = hit_rate
+        return hit_rate
@@ -1,7 +1,55 @@
-import math
+import os
+import re
 import numpy as np
 
 
+# データファイルのセクション名
+_SECTION_NAMES = [
+    "Masses",
+    "Velocities",
+    "Atoms",
+    "Bonds",
+    "Angles",
+    "Dihedrals",
+    "Impropers",
+    "Pair Coeffs",
+    "Bond Coeffs",
+    "Angle Coeffs",
+    "Dihedral Coeffs",
+    "Improper Coeffs",
+]
+# 行頭のセクション名 (後ろの "# bond" などのコメントを含めて 1 行) にマッチする
+# ※ 1 行目はタイトル行なので，セクション名は必ず改行の直後にある
+_SECTION_PATTERN = re.compile(
+    rb"\n(" + b"|".join(name.encode() for name in _SECTION_NAMES) + rb")\b[^\n]*"
+)
+_COMMENT_PATTERN = re.compile(rb"#[^\n]*")
+
+
+def _parse_table(body):
+    """
+    セクションの本体 (数値の行の並び) を 2 次元配列にまとめてパースする
+
+    Args:
+        body (bytes): セクションヘッダーの次の行から次のセクションまで
+
+    Returns:
+        table (np.array): shape=(nrows, ncols)
+    """
+    body = _COMMENT_PATTERN.sub(b"", body)
+    rows = body.split(b"\n", 64)
+    first = next((row for row in rows if row.strip()), b"")
+    ncols = len(first.split())
+    if ncols == 0:
+        return np.empty((0, 0))
+    values = np.fromstring(body.decode(), sep=" ")
+    if len(values) % ncols != 0:
+        # 行によって列数が違う場合は，最初の行の列数に揃えて読む
+        lines = [line.split()[:ncols] for line in body.decode().splitlines() if line.strip()]
+        return np.array(lines, dtype=np.float64)
+    return values.reshape(-1, ncols)
+
+
 class LammpsData:
     """
     LAMMPSのデータファイルを読み込み，データを格納するクラス
@@ -38,8 +86,8 @@ class LammpsData:
         原子の質量情報を保持するクラス
 
         Attributes:
-            id (list of int): 原子タイプのリスト
-            mass (list of float): 原子の質量のリスト
+            id (np.array of int): 原子タイプ
+            mass (np.array of float): 原子の質量
         """
 
         def __init__(self):
@@ -72,14 +120,14 @@ class LammpsData:
         原子情報を保持するクラス
 
         Attributes:
-            id (list of int): 原子IDのリスト
-            mol_id (list of int): 分子IDのリスト
-            type (list of int): 原子タイプのリスト
-            coords (list of list of float): 座標 (x, y, z) のリスト
+            id (np.array of int): 原子ID (昇順)
+            mol_id (np.array of int): 分子ID
+            type (np.array of int): 原子タイプ
+            coords (np.array of float): 座標 (x, y, z), shape=(num_atoms, 3)
             num_atoms (int): 原子の総数
             num_mols (int): 分子の総数
             num_types (int): 原子タイプの数
-            image_flag (list of tuple of float): 原子のイメージフラグのリスト
+            image_flag (np.array of float): 原子のイメージフラグ, shape=(num_atoms, 3)
         """
 
         def __init__(self):
@@ -97,9 +145,9 @@ class LammpsData:
         ボンド情報を保持するクラス
 
         Attributes:
-            id (list of int): ボンドIDのリスト
-            type (list of int): ボンドタイプのリスト
-            atoms (list of tuple): ボンドを構成する原子のリスト
+            id (np.array of int): ボンドID (昇順)
+            type (np.array of int): ボンドタイプ
+            atoms (np.array of int): ボンドを構成する原子, shape=(num_bonds, 2)
             num_bonds (int): ボンドの総数
             num_types (int): ボンドタイプの数
         """
@@ -133,6 +181,7 @@ class LammpsData:
     def read(self, filename):
         """
         LAMMPSデータファイルからデータを読み込み，各属性に格納する
+        ファイル全体を読み込んでセクションの位置を探し，各セクションを NumPy でまとめてパースする
 
         Args:
             filename (str): 読み込むファイル名
@@ -140,11 +189,19 @@ class LammpsData:
         if filename is not None:
             self.filename = filename
 
-        with open(self.filename, "r") as f:
-            lines = f.readlines()
+        with open(self.filename, "rb") as f:
+            text = f.read()
 
-        # --- 1. ヘッダー部からボックス情報や型数を取得 ---
-        for line in lines:
+        # --- 1. セクションヘッダーの位置 (バイトオフセット) を探す ---
+        headers = list(_SECTION_PATTERN.finditer(text))
+        sections = {}
+        for k, m in enumerate(headers):
+            end = headers[k + 1].start() if k + 1 < len(headers) else len(text)
+            sections[m.group(1).decode()] = text[m.end() : end]
+
+        # --- 2. ヘッダー部 (最初のセクションより前) からボックス情報や型数を取得 ---
+        head = text[: headers[0].start()] if headers else text
+        for line in head.decode().splitlines():
             line_strip = line.strip()
             if "xlo" in line_strip and "xhi" in line_strip:
                 parts = line_strip.split()
@@ -177,137 +234,33 @@ class LammpsData:
                 parts = line_strip.split()
                 self.angles.num_types = int(parts[0])
 
-        # --- 2. セクション毎にデータをパース ---
-        section_names = [
-            "Masses",
-            "Velocities",
-            "Atoms",
-            "Bonds",
-            "Angles",
-            "Dihedrals",
-            "Impropers",
-            "Pair Coeffs",
-            "Bond Coeffs",
-            "Angle Coeffs",
-            "Dihedral Coeffs",
-            "Improper Coeffs",
-        ]
-        current_section = None
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-
-            # セクションヘッダーの検出
-            if any(line.startswith(sec) for sec in section_names):
-                # セクション名を現在のセクションとして記憶
-                current_section = line.split()[0]
-                # セクション名の行とその次の空行（またはコメント行）をスキップ
-                i += 2
-                continue
-
-            # セクション外なら次の行へ
-            if current_section is None:
-                i += 1
-                continue
-
-            # 空行やコメント行はスキップ
-            if not line or line.startswith("#"):
-                i += 1
-                continue
-
-            # 新たなセクションが始まった場合は current_section をリセット
-            if any(line.startswith(sec) for sec in section_names):
-                current_section = None
-                continue
-
-            # データ行のパース
-            parts = line.split()
-            if current_section == "Atoms":
-                # 例: "1 1 1 0.0 0.0 0.0 ..." (原子ID, 分子ID, タイプ, x, y, z, ...)
-                if len(parts) >= 7:
-                    self.atoms.id.append(int(parts[0]))
-                    self.atoms.mol_id.append(int(parts[1]))
-                    self.atoms.type.append(int(parts[2]))
-                    self.atoms.coords.append(
-                        [float(parts[3]), float(parts[4]), float(parts[5])]
-                    )
-                    self.atoms.image_flag.append(
-                        (float(parts[6]), float(parts[7]), float(parts[8]))
-                    )
-                else:
-                    self.atoms.id.append(int(parts[0]))
-                    self.atoms.mol_id.append(int(parts[1]))
-                    self.atoms.type.append(int(parts[2]))
-                    self.atoms.coords.append(
-                        [float(parts[3]), float(parts[4]), float(parts[5])]
-                    )
-            elif current_section == "Masses":
-                if len(parts) >= 2:
-                    self.masses.id.append(int(parts[0]))
-                    self.masses.mass.append(float(parts[1]))
-            elif current_section == "Bonds":
-                if len(parts) >= 4:
-                    self.bonds.id.append(int(parts[0]))
-                    self.bonds.type.append(int(parts[1]))
-                    self.bonds.atoms.append((int(parts[2]), int(parts[3])))
-            # TODO: 他のセクション (Masses, Angle, など) のパース処理も同様に追加
-
-            i += 1
+        # --- 3. セクション毎にデータをまとめてパース ---
+        if "Atoms" in sections:
+            # 例: "1 1 1 0.0 0.0 0.0 ..." (原子ID, 分子ID, タイプ, x, y, z, ix, iy, iz)
+            table = _parse_table(sections["Atoms"])
+            # 原子 ID でソートする
+            table = table[np.argsort(table[:, 0], kind="stable")]
+            self.atoms.id = table[:, 0].astype(np.int64)
+            self.atoms.mol_id = table[:, 1].astype(np.int64)
+            self.atoms.type = table[:, 2].astype(np.int64)
+            self.atoms.coords = table[:, 3:6].copy()
+            if table.shape[1] >= 7:
+                self.atoms.image_flag = table[:, 6:9].copy()
+        if "Masses" in sections:
+            table = _parse_table(sections["Masses"])
+            self.masses.id = table[:, 0].astype(np.int64)
+            self.masses.mass = table[:, 1].copy()
+        if "Bonds" in sections:
+            table = _parse_table(sections["Bonds"])
+            # ボンド ID でソートする
+            table = table[np.argsort(table[:, 0], kind="stable")]
+            self.bonds.id = table[:, 0].astype(np.int64)
+            self.bonds.type = table[:, 1].astype(np.int64)
+            self.bonds.atoms = table[:, 2:4].astype(np.int64)
+        # TODO: 他のセクション (Angle など) のパース処理も同様に追加
+
         # 被ってない，mol_id の数を数える
-        self.atoms.num_mols = len(set(self.atoms.mol_id))
-        # # Atom, Bond セクションのデータを sort
-        # (
-        #     self.atoms.id,
-        #     self.atoms.mol_id,
-        #     self.atoms.type,
-        #     self.atoms.coords,
-        #     self.atoms.image_flag,
-        # ) = map(
-        #     list,
-        #     zip(
-        #         *sorted(
-        #             zip(
-        #                 self.atoms.id,
-        #                 self.atoms.mol_id,
-        #                 self.atoms.type,
-        #                 self.atoms.coords,
-        #                 self.atoms.image_flag,
-        #             ),
-        #             key=lambda x: x[0],
-        #         )
-        #     ),
-        # )
-        # 例: self.atoms に各属性が存在するかをチェックして、存在するものだけでソートする
-
-        # ソート対象とする属性名のリスト
-        attributes = ['id', 'mol_id', 'type', 'coords', 'image_flag']
-
-        # 存在する属性のみ抽出
-        present_attrs = [attr for attr in attributes if hasattr(self.atoms, attr)]
-
-        if present_attrs:
-            # 存在する属性からリストを作成
-            arrays = [getattr(self.atoms, attr) for attr in present_attrs]
-
-            # 各リストの要素をタプルにまとめ、先頭要素でソート
-            sorted_zipped = sorted(zip(*arrays), key=lambda x: x[0])
-            
-            # ソート後、再び属性ごとのリストに戻す
-            sorted_arrays = list(map(list, zip(*sorted_zipped)))
-            
-            # ソートした結果を元の属性に代入
-            for attr, sorted_array in zip(present_attrs, sorted_arrays):
-                setattr(self.atoms, attr, sorted_array)
-
-        self.bonds.id, self.bonds.type, self.bonds.atoms = map(
-            list,
-            zip(
-                *sorted(
-                    zip(self.bonds.id, self.bonds.type, self.bonds.atoms),
-                    key=lambda x: x[0],
-                )
-            ),
-        )
+        self.atoms.num_mols = len(np.unique(self.atoms.mol_id))
 
     def write(self, filename):
         """
@@ -364,93 +317,266 @@ class LammpsData:
         ポリマーの原子座標を周期境界条件でラップする
         このとき，結合が切れないように原子座標を調整し，
         分子の重心（COM）がシミュレーションセル内に収まるように全体を平行移動する
+
+        原子を分子ID毎にまとめた (分子数, 最大原子数, 3) の配列に並べ，
+        全ての分子を同時に処理する．Python のループは分子内の原子の順番についてだけ回す．
         """
-        # 分子IDは 1 から始まる
-        for i in range(1, self.atoms.num_mols + 1):
-            # 分子IDが i の原子のインデックスを取得
-            idx = [j for j, mol_id in enumerate(self.atoms.mol_id) if mol_id == i]
-            if not idx:
-                continue
-
-            # シミュレーションセル各方向の境界とセルサイズを取得
-            # ※ここではセル情報を self.box.x, self.box.y, self.box.z としてアクセスしています
-            box_bounds = {"x": self.box.x, "y": self.box.y, "z": self.box.z}
-            box_lengths = {
-                axis: box_bounds[axis][1] - box_bounds[axis][0] for axis in box_bounds
-            }
-
-            # 1. 分子内で「アンラップ」する（隣接原子との連続性を保持）
-            # 最初の原子はそのまま採用
-            unwrapped_coords = [list(self.atoms.coords[idx[0]])]
-            if idx and idx[0] < len(self.atoms.image_flag):
-                unwrapped_image_flag = [list(self.atoms.image_flag[idx[0]])]
-            for k in range(1, len(idx)):
-                prev_coord = unwrapped_coords[k - 1]
-                current_coord = list(self.atoms.coords[idx[k]])
-                new_coord = []
-                new_image = []
-                for d, axis in enumerate(["x", "y", "z"]):
-                    lo, hi = box_bounds[axis]
-                    L = box_lengths[axis]
-                    diff = current_coord[d] - prev_coord[d]
-                    # 補正：差がセルサイズの半分を超えているかどうかで判断
-                    if diff > 0.5 * L:
-                        shift_val = 1
-                    elif diff < -0.5 * L:
-                        shift_val = -1
-                    else:
-                        shift_val = 0
-                    new_coord.append(current_coord[d] - shift_val * L)
-                    if idx and idx[0] < len(self.atoms.image_flag):
-                        new_image.append(float(shift_val))
-                unwrapped_coords.append(new_coord)
-                # image_flag はタプルの場合が多いので、リスト内各成分同士を足し合わせたタプルにする
-                if idx and idx[0] < len(self.atoms.image_flag):
-                    unwrapped_image_flag.append(
-                        tuple(
-                            float(a) + float(b)
-                            for a, b in zip(self.atoms.image_flag[idx[k]], new_image)
-                        )
-                    )
-
-            # 2. 分子の重心（COM）を計算（各原子の質量が等しいと仮定）
-            n_atoms = len(unwrapped_coords)
-            com = [
-                sum(coord[d] for coord in unwrapped_coords) / n_atoms for d in range(3)
-            ]
-
-            # 3. COM がセル内に入るように全体を平行移動するシフト量を算出
-            shift = []  # 座標のシフト（float 値）
-            shift_image = []  # 画像フラグのシフト（整数値）
-            for d, axis in enumerate(["x", "y", "z"]):
-                lo, hi = box_bounds[axis]
-                L = box_lengths[axis]
-                # modulo 演算で COM を [lo, hi) に写像
-                new_com = ((com[d] - lo) % L) + lo
-                shift_val = new_com - com[d]
-                shift.append(shift_val)
-                # 負の場合も正しく扱うため math.floor を利用
-                shift_image.append(math.floor((com[d] - lo) / L))
-
-            # 4. 各原子座標と image_flag にシフトを適用
-            wrapped_coords = []
-            new_image_flag = []
-            for coord in unwrapped_coords:
-                new_coord = [coord[d] + shift[d] for d in range(3)]
-                wrapped_coords.append(new_coord)
-            if idx and idx[0] < len(self.atoms.image_flag):
-                for image_flag in unwrapped_image_flag:
-                    new_img = [
-                        float(image_flag[d]) + float(shift_image[d]) for d in range(3)
-                    ]
-                    new_image_flag.append(new_img)
-
-            # 5. 元の座標リストと image_flag を更新
-            for index, new_coord in zip(idx, wrapped_coords):
-                self.atoms.coords[index] = new_coord
-            if hasattr(self.atoms, 'image_flag'):
-                for index, new_img in zip(idx, new_image_flag):
-                    self.atoms.image_flag[index] = tuple(new_img)
+        coords = np.array(self.atoms.coords, dtype=np.float64).reshape(-1, 3)
+        mol_id = np.asarray(self.atoms.mol_id)
+        image_flag = np.array(self.atoms.image_flag, dtype=np.float64).reshape(-1, 3)
+        has_image = len(image_flag) == len(coords) and len(coords) > 0
+
+        # シミュレーションセル各方向の境界とセルサイズ
+        box_bounds = np.array([self.box.x, self.box.y, self.box.z], dtype=np.float64)
+        lo = box_bounds[:, 0]
+        L = box_bounds[:, 1] - box_bounds[:, 0]
+
+        # 分子IDは 1 から始まる．分子毎に，元の並び順を保ったまま原子をまとめる
+        sel = np.nonzero((mol_id >= 1) & (mol_id <= self.atoms.num_mols))[0]
+        if len(sel) == 0:
+            return
+        order = sel[np.argsort(mol_id[sel], kind="stable")]
+        _, start, counts = np.unique(mol_id[order], return_index=True, return_counts=True)
+        nmols, maxlen = len(counts), counts.max()
+        row = np.repeat(np.arange(nmols), counts)
+        col = np.arange(len(order)) - np.repeat(start, counts)
+        valid = np.zeros((nmols, maxlen), dtype=bool)
+        valid[row, col] = True
+        x = np.zeros((nmols, maxlen, 3))
+        x[row, col] = coords[order]
+
+        # 1. 分子内で「アンラップ」する（隣接原子との連続性を保持）
+        # 各原子は 1 つ前の（アンラップ済みの）原子との差がセルサイズの半分を超えていれば
+        # 1 セル分だけずらす．1 つ前の結果に依存するので，原子の順番についてはループする
+        unwrapped = x.copy()
+        shift_val = np.zeros((nmols, maxlen, 3))
+        for k in range(1, maxlen):
+            diff = x[:, k] - unwrapped[:, k - 1]
+            shift_val[:, k] = np.where(diff > 0.5 * L, 1.0, np.where(diff < -0.5 * L, -1.0, 0.0))
+            unwrapped[:, k] = x[:, k] - shift_val[:, k] * L
+        unwrapped[~valid] = 0.0
+
+        # 2. 分子の重心（COM）を計算（各原子の質量が等しいと仮定）
+        # 組み込みの sum は Python 3.12 から補償付きの加算なので，結果を揃えるために sum を使う
+        # (padding の 0 は和を変えない)
+        com = np.array(
+            [[sum(v) for v in mol] for mol in unwrapped.transpose(0, 2, 1).tolist()]
+        ) / counts[:, None]
+
+        # 3. COM がセル内に入るように全体を平行移動するシフト量を算出
+        new_com = ((com - lo) % L) + lo
+        shift = new_com - com
+        shift_image = np.floor((com - lo) / L)
+
+        # 4. 各原子座標と image_flag にシフトを適用し，元の配列を更新
+        coords[order] = unwrapped[row, col] + shift[row]
+        self.atoms.coords = coords
+        if has_image:
+            image = image_flag[order]
+            image += shift_val[row, col]
+            image_flag[order] = image + shift_image[row]
+            self.atoms.image_flag = image_flag
+
+
+class LammpsDump:
+    """
+    LAMMPSのダンプファイル (テキスト形式, ITEM: ヘッダー) をフレーム毎に読み込むクラス
+
+    ファイル全体をメモリに載せず，1 フレームずつ座標を読み込む．
+    最初にファイルを 1 度だけ走査して各フレームの先頭のバイト位置 (オフセット) を記録するので，
+    k 番目のフレームへは走査せずに seek できる．
+
+    座標は xu yu zu (アンラップ済み), x y z + ix iy iz, xs ys zs (+ ix iy iz), x y z の順に
+    利用可能なものを使う．イメージフラグが無い場合は結合が切れないように最小イメージ規約で
+    アンラップする．いずれの場合も polyWrap と同様に，分子の重心がセル内に入るように平行移動する．
+
+    Usage:
+        dump = LammpsDump("traj.dump")
+        for coords in dump:  # coords: shape=(nchains, nbeads, 3)
+            ...
+        coords = dump[100]  # 100 番目のフレーム
+
+    Attributes:
+        filename (str): ダンプファイルのパス
+        offsets (np.array of int64): 各フレームの先頭のバイト位置
+        timestep (int): 最後に読み込んだフレームのタイムステップ
+        box (LammpsData.Box): 最後に読み込んだフレームのボックス情報
+        num_atoms (int): 最後に読み込んだフレームの原子数
+        num_mols (int): 最後に読み込んだフレームの分子数
+    """
+
+    # オフセットを探す時に 1 度に読み込むバイト数
+    _CHUNK_SIZE = 1 << 24
+    _FRAME_HEADER = b"ITEM: TIMESTEP"
+
+    def __init__(self, filename, index_file=None):
+        """
+        Args:
+            filename (str): LAMMPSダンプファイルのパス
+            index_file (str): フレームのオフセットを保存するファイル (.npy)．
+                存在してダンプファイルより新しければ読み込み，無ければ走査して保存する
+        """
+        self.filename = filename
+        self.timestep = None
+        self.box = LammpsData.Box()
+        self.num_atoms = 0
+        self.num_mols = 0
+        self.offsets = self._load_index(index_file)
+
+    def _load_index(self, index_file):
+        if index_file is not None and os.path.exists(index_file):
+            if os.path.getmtime(index_file) >= os.path.getmtime(self.filename):
+                return np.load(index_file)
+        offsets = self._scan_offsets()
+        if index_file is not None:
+            np.save(index_file, offsets)
+        return offsets
+
+    def _scan_offsets(self):
+        """
+        ファイルを固定サイズのチャンクで読み，"ITEM: TIMESTEP" の行頭の位置を集める
+        """
+        header = self._FRAME_HEADER
+        offsets = []
+        with open(self.filename, "rb") as f:
+            pos = 0  # buf[0] のファイル上の位置
+            buf = b""
+            while True:
+                chunk = f.read(self._CHUNK_SIZE)
+                if not chunk:
+                    break
+                buf += chunk
+                k = buf.find(header)
+                while k >= 0:
+                    # 行頭にあるものだけをフレームの先頭とみなす
+                    if pos + k == 0 or k > 0 and buf[k - 1 : k] == b"\n":
+                        offsets.append(pos + k)
+                    k = buf.find(header, k + 1)
+                # チャンクの境界を跨ぐヘッダーのために，直前の改行を含めて末尾を残す
+                # (残した部分で再び見つかったものは np.unique で除く)
+                keep = min(len(buf), len(header) + 1)
+                pos += len(buf) - keep
+                buf = buf[len(buf) - keep :]
+        return np.unique(np.array(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return self.frames()
+
+    def __getitem__(self, k):
+        return self.read_frame(k)
+
+    def frames(self, start=0, stop=None, step=1):
+        """
+        フレームを順に読み込むジェネレータ
+
+        Args:
+            start, stop, step (int): range(len(self))[start:stop:step] のフレームを読む
+
+        Yields:
+            coords (np.array): shape=(nchains, nbeads, 3)
+        """
+        with open(self.filename, "rb") as f:
+            for k in range(len(self))[start:stop:step]:
+                f.seek(self.offsets[k])
+                yield self._read(f)
+
+    def read_frame(self, k):
+        """
+        k 番目のフレームの座標を返す
+
+        Returns:
+            coords (np.array): shape=(nchains, nbeads, 3)
+        """
+        with open(self.filename, "rb") as f:
+            f.seek(self.offsets[k])
+            return self._read(f)
+
+    def _read(self, f):
+        """
+        ファイルの現在位置から 1 フレーム分を読み込む
+        """
+        items = {}
+        while "ATOMS" not in items:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{self.filename}: truncated frame")
+            if line.startswith(b"ITEM:"):
+                name = line[5:].decode().strip()
+                key = name.split()[0] if not name.startswith("NUMBER") else "NUMBER"
+                if key == "BOX":
+                    items[key] = [f.readline().split() for _ in range(3)]
+                elif key == "ATOMS":
+                    items[key] = name.split()[1:]
+                else:
+                    items[key] = f.readline().split()
+        self.timestep = int(items["TIMESTEP"][0])
+        self.num_atoms = int(items["NUMBER"][0])
+        for axis, bounds in zip("xyz", items["BOX"]):
+            lo, hi = float(bounds[0]), float(bounds[1])
+            setattr(self.box, axis, (lo, hi))
+            setattr(self.box, "l" + axis, hi - lo)
+        columns = items["ATOMS"]
+
+        # 原子の行をまとめてパースする
+        text = b"".join(f.readline() for _ in range(self.num_atoms))
+        table = np.fromstring(text, sep=" ").reshape(self.num_atoms, len(columns))
+        col = {name: table[:, i] for i, name in enumerate(columns)}
+        for name in ("id", "mol"):
+            if name not in col:
+                raise ValueError(f"{self.filename}: dump has no '{name}' column")
+
+        lo = np.array([self.box.x[0], self.box.y[0], self.box.z[0]])
+        L = np.array([self.box.lx, self.box.ly, self.box.lz])
+        unwrapped = True
+        if all(c in col for c in ("xu", "yu", "zu")):
+            coords = np.stack([col["xu"], col["yu"], col["zu"]], axis=1)
+        elif all(c in col for c in ("x", "y", "z")):
+            coords = np.stack([col["x"], col["y"], col["z"]], axis=1)
+            unwrapped = False
+        elif all(c in col for c in ("xs", "ys", "zs")):
+            coords = lo + np.stack([col["xs"], col["ys"], col["zs"]], axis=1) * L
+            unwrapped = False
+        else:
+            raise ValueError(f"{self.filename}: dump has no coordinate columns")
+        if not unwrapped and all(c in col for c in ("ix", "iy", "iz")):
+            coords = coords + np.stack([col["ix"], col["iy"], col["iz"]], axis=1) * L
+            unwrapped = True
+
+        # 分子 ID, 原子 ID の順に並べる
+        order = np.lexsort((col["id"], col["mol"]))
+        mol_id = col["mol"][order]
+        coords = coords[order]
+        _, counts = np.unique(mol_id, return_counts=True)
+        self.num_mols = len(counts)
+        if np.any(counts != counts[0]):
+            raise ValueError(f"{self.filename}: molecules have different numbers of atoms")
+        coords = coords.reshape(self.num_mols, counts[0], 3)
+        if not unwrapped:
+            # 隣接原子間の変位に最小イメージ規約を適用して積算する
+            disp = np.diff(coords, axis=1)
+            disp -= L * np.round(disp / L)
+            coords = np.concatenate([coords[:, :1], disp], axis=1).cumsum(axis=1)
+        return wrap_com(coords, lo, L)
+
+
+def wrap_com(coords, lo, L):
+    """
+    分子の重心がセル [lo, lo + L) に入るように，各分子を平行移動する
+
+    Args:
+        coords (np.array): shape=(nmols, nbeads, 3), アンラップ済みの座標
+        lo (np.array): shape=(3), セルの下端
+        L (np.array): shape=(3), セルの長さ
+
+    Returns:
+        coords (np.array): shape=(nmols, nbeads, 3)
+    """
+    com = coords.mean(axis=1, keepdims=True)
+    new_com = (com - lo) % L + lo
+    return coords + (new_com - com)
 
 
 # 動作確認用（必要に応じてパスを適宜変更してください）
@@ -0,0 +1,50 @@
+"""
+Birth-sorted matching of persistence diagrams for Threading.compute (method="sorted").
+
+Fortran の threading_ragged は passive chain の各点を PD_i_cup_j の全ての点と比較する
+(セル毎に O(P P'))．ここでは passive chain 毎に PD_i の点を birth の昇順に 1 回だけ並べ，
+PD_i_cup_j の各点からは birth の差が threshold 以内になりうる PD_i の点の範囲を
+Fortran の threading_sorted で二分探索する (セル毎に O(P' log P))．
+並べ替えるのは PD_i の方で，PD_i_cup_j の各セルは並べ替えずにそのまま走査する．
+"""
+
+import numpy as np
+
+
+def threading_sorted(points_i, offsets_i, pd_i_cup_j, threshold=1e-10):
+    """
+    Find the points of PD_i that are not in PD_i_cup_j by binary search on birth.
+
+    The points of each passive chain in PD_i are sorted by birth once; every
+    point of a PD_i_cup_j cell (left unsorted) binary-searches the PD_i points
+    whose birth may lie within threshold of its own and compares only those.
+    Gives the same result as fc.threading_ragged: a point of PD_i matches a
+    point of PD_i_cup_j when both |birth difference| and |death difference|
+    are smaller than threshold.
+
+    args:
+        points_i: np.array, shape=(total_points_i, 2), PD_i of all chains in chain order
+        offsets_i: np.array, shape=(nchains + 1), points of chain i are points_i[offsets_i[i]:offsets_i[i + 1]]
+        pd_i_cup_j: RaggedPD with (passive, active) cells
+        threshold: float
+
+    return:
+        keep: np.array of int8, shape=(total_points_i, active), the point survives in PD(i cup j),
+            in Fortran order like the keep of fc.threading_ragged
+        flags: np.array of int8, shape=(active, passive)
+        counts: np.array, shape=(active, passive), number of points of passive chain i kept for active chain j
+    """
+    from .fortran import compute as fc
+
+    # passive chain の中で birth の昇順に並べた点の番号 (チェインの範囲は変わらない)
+    chain_i = np.repeat(np.arange(len(offsets_i) - 1), np.diff(offsets_i))
+    order_i = np.lexsort((points_i[:, 0], chain_i))
+    return fc.threading_sorted(
+        points_i.T,
+        offsets_i,
+        order_i,
+        pd_i_cup_j.points.T,
+        pd_i_cup_j.offsets,
+        pd_i_cup_j.index.T,
+        threshold,
+    )
@@ -0,0 +1,328 @@
+"""
+Executors (serial, thread pool, process pool) and shared-memory arrays for the compute classes.
+
+PD_i と PD_i_cup_j はタスクのリストを作って executor に渡すだけで，どこで実行されるかは知らない．
+どの executor も share(array) で座標を渡し，ワーカー関数は attach(handle) で配列を得る．
+プロセスの場合は座標を multiprocessing.shared_memory に 1 回だけ書き込み，各タスクには
+共有メモリの名前と担当するインデックスの範囲だけを渡す．スレッドと逐次実行では配列をそのまま渡す．
+HomologicalThreading は多数のフレームを処理する時に同じ executor を使い回す．
+"""
+
+import concurrent.futures
+import multiprocessing as mp
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .resources import available_cores, fork_safe
+
+
+class SharedArray:
+    """
+    NumPy array placed in shared memory.
+
+    The parent process creates it with share() and owns the memory; workers
+    get a view of it from attach(handle) without copying.
+
+    Attributes:
+        array: np.array, view of the shared memory in the parent process
+        handle: tuple, (name, shape, dtype) passed to the workers
+    """
+
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self._shm.buf)
+        self.array[...] = array
+        self.handle = (self._shm.name, array.shape, array.dtype.str)
+
+    def close(self):
+        """Release and remove the shared memory."""
+        if self._shm is None:
+            return
+        self.array = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LocalArray:
+    """
+    Array passed as is to workers running in this process (see SerialExecutor).
+
+    Attributes:
+        array: np.array
+        handle: np.array, the same array
+    """
+
+    def __init__(self, array):
+        self.array = self.handle = array
+
+    def close(self):
+        self.array = self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ワーカー側で開いている共有メモリ (name, SharedMemory, array)
+_attached = None
+
+
+def attach(handle):
+    """
+    Return the array of a SharedArray (or LocalArray) handle inside a worker.
+
+    The block stays mapped until release() (or until a block with another
+    name is attached). Workers drop their views of the array and call
+    release() at the end of each task, so no worker keeps a segment mapped
+    after the parent unlinks it.
+    """
+    global _attached
+    if isinstance(handle, np.ndarray):
+        return handle
+    name, shape, dtype = handle
+    if _attached is not None and _attached[0] == name:
+        return _attached[2]
+    if _attached is not None:
+        _attached[1].close()
+        _attached = None
+    # 親プロセスが unlink するので，ワーカーでは resource_tracker に登録しない
+    shm = shared_memory.SharedMemory(name=name, track=False)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    _attached = (name, shm, array)
+    return array
+
+
+def release():
+    """
+    Close the shared memory opened by attach() in this worker.
+
+    Every view of the array returned by attach() must be gone, otherwise
+    SharedMemory.close raises BufferError.
+    """
+    global _attached
+    if _attached is None:
+        return
+    shm = _attached[1]
+    _attached = None
+    shm.close()
+
+
+class SerialExecutor:
+    """
+    Executor running every task in the calling thread.
+
+    All executors have the same interface: name, num_workers, start(),
+    share(array), map(func, tasks), imap_unordered(func, tasks) and close().
+    """
+
+    name = "serial"
+    num_workers = 1
+
+    def __init__(self, num_workers=None):
+        pass
+
+    def start(self):
+        """Start the workers now instead of on first use. Returns self."""
+        return self
+
+    def share(self, array):
+        """Return a LocalArray, the workers see the array itself."""
+        return LocalArray(array)
+
+    def map(self, func, tasks):
+        return [func(task) for task in tasks]
+
+    def imap_unordered(self, func, tasks):
+        return (func(task) for task in tasks)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ThreadExecutor(SerialExecutor):
+    """
+    Long-lived pool of worker threads.
+
+    The tasks share the arrays of this process without copying. Threads only
+    run in parallel where the work releases the GIL (NumPy, qhull, native
+    extensions) or on a free-threaded Python build.
+    """
+
+    name = "thread"
+
+    def __init__(self, num_workers=None):
+        self.num_workers = default_workers() if num_workers is None else num_workers
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.num_workers, thread_name_prefix="homological-threading")
+        return self._pool
+
+    def start(self):
+        self.pool
+        return self
+
+    def map(self, func, tasks):
+        return list(self.pool.map(func, tasks))
+
+    def imap_unordered(self, func, tasks):
+        """Yield the results in the order the tasks finish."""
+        futures = [self.pool.submit(func, task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class WorkerPool:
+    """
+    Long-lived pool of worker processes.
+
+    The processes are started on first use (or by start()) and kept until
+    close(), so one pool can serve every frame of a trajectory or every file
+    of a batch. Call start() before starting other threads (e.g. a
+    FramePipeline): a pool started while other threads are running uses
+    forkserver instead of fork.
+
+    Usage:
+        with WorkerPool() as pool:
+            for filename in files:
+                pds = HomologicalThreading(pool=pool)
+                ...
+    """
+
+    name = "process"
+
+    def __init__(self, num_processes=None):
+        if num_processes is None:
+            num_processes = default_workers()
+        self.num_processes = num_processes
+        self._pool = None
+
+    @property
+    def num_workers(self):
+        return self.num_processes
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # 親で複数スレッドの OpenMP を使った後に fork すると子の OpenMP が止まるので，その後は forkserver で起動する
+            # 他のスレッドが動いている時に fork すると，そのスレッドが持っていたロックが子で解放されないので同様
+            forkable = fork_safe() and threading.active_count() == 1
+            context = mp.get_context(None if forkable else "forkserver")
+            self._pool = context.Pool(self.num_processes)
+        return self._pool
+
+    def start(self):
+        self.pool
+        return self
+
+    def share(self, array):
+        """Copy array into shared memory, return a SharedArray."""
+        return SharedArray(array)
+
+    def map(self, func, tasks):
+        return self.pool.map(func, tasks)
+
+    def imap_unordered(self, func, tasks):
+        """Hand the tasks out one by one to whichever worker is free."""
+        return self.pool.imap_unordered(func, tasks, chunksize=1)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# executor の名前とクラス
+EXECUTORS = {"serial": SerialExecutor, "thread": ThreadExecutor, "process": WorkerPool}
+
+
+def default_workers():
+    """
+    Number of workers when none is given: the CPUs this process may run on.
+    OMP_NUM_THREADS is not used, it is the number of OpenMP threads (see resources.py).
+    """
+    return available_cores()
+
+
+def make_executor(name, num_workers=None):
+    """
+    Create an executor by name ("serial", "thread" or "process", see EXECUTORS).
+    """
+    if name not in EXECUTORS:
+        raise ValueError(f"Unknown executor: {name} (choose from {', '.join(EXECUTORS)})")
+    return EXECUTORS[name](num_workers)
+
+
+def schedule(costs, nchunks):
+    """
+    Split work items into chunks of about equal estimated cost.
+
+    The items are sorted by decreasing cost, so the expensive chunks are
+    handed out first and the cheap ones fill the gaps at the end
+    (longest-processing-time-first).
+
+    args:
+        costs: np.array, shape=(nitems), estimated cost of each item
+        nchunks: int, target number of chunks
+
+    return:
+        chunks: list of np.array, item numbers of each chunk
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    if len(costs) == 0:
+        return []
+    order = np.argsort(-costs, kind="stable")
+    # 累積コストが target を超える毎に区切る．重い要素は 1 つで 1 チャンクになる
+    target = costs.sum() / max(nchunks, 1)
+    cumsum = np.cumsum(costs[order])
+    bounds = np.searchsorted(cumsum, target * np.arange(1, nchunks), side="right")
+    return [chunk for chunk in np.split(order, np.unique(bounds)) if len(chunk) > 0]
+
+
+def utilization(stats, wall_time):
+    """
+    Busy fraction of each worker during a parallel computation.
+
+    args:
+        stats: iterable of (worker, busy_time) reported by the tasks (worker: see profiling.worker_id)
+        wall_time: float, wall time of the whole computation
+
+    return:
+        utilization: dict, worker -> busy_time / wall_time
+    """
+    busy = {}
+    for worker, busy_time in stats:
+        busy[worker] = busy.get(worker, 0.0) + busy_time
+    return {worker: t / wall_time if wall_time > 0 else 0.0 for worker, t in sorted(busy.items())}
@@ -0,0 +1,230 @@
+"""
+Frame pipeline for whole trajectories.
+
+フレーム k+1 の読み込み，フレーム k の計算，フレーム k-1 の書き出しを
+サイズ上限付きのキューでつないで並行に実行する．
+読み込みと書き出しはスレッドで行い，計算は呼び出し元のスレッドで (WorkerPool を使って) 行う．
+"""
+
+import pathlib
+import queue
+import threading
+import time
+
+from .main import HomologicalThreading
+
+# ダンプファイル (トラジェクトリ) とみなす拡張子
+DUMP_SUFFIXES = (".dump", ".lammpstrj")
+
+# キューの終わりを表す印
+_DONE = object()
+
+
+def frames(inputs, pool=None, cache=None, disk_cache=None, profiler=None, resources=None):
+    """
+    Read the frames of LAMMPS data and dump files one by one.
+
+    A data file gives one frame named after the file, a dump file (see
+    DUMP_SUFFIXES) gives all of its frames named <stem>_<frame number>.
+
+    args:
+        inputs: list of str, paths to the input files
+        pool: WorkerPool passed to each HomologicalThreading
+        cache: FrameCache passed to each HomologicalThreading, reuses the diagrams of unmoved chains
+        disk_cache: DiagramCache passed to each HomologicalThreading
+        profiler: Profiler, each frame is profiled by profiler.new() (same collectors)
+        resources: ResourcePlanner shared by all frames (the plan is logged only when it changes)
+
+    yield:
+        name: str, name of the frame (used for the output file)
+        pds: HomologicalThreading with the metadata of the frame
+        coords: np.array, shape=(nchains, nbeads, 3)
+    """
+    for filename in inputs:
+        path = pathlib.Path(filename)
+        if path.suffix in DUMP_SUFFIXES:
+            reader = HomologicalThreading()
+            for k, coords in enumerate(reader.iter_lmpdump(str(path))):
+                pds = HomologicalThreading(
+                    pool=pool, cache=cache, disk_cache=disk_cache, profile=_new_profiler(profiler), resources=resources
+                )
+                for key, value in reader.metadata.items():
+                    if key != "timestamp":
+                        pds.metadata[key] = value
+                yield f"{path.stem}_{k:06d}", pds, coords
+        else:
+            pds = HomologicalThreading(
+                pool=pool, cache=cache, disk_cache=disk_cache, profile=_new_profiler(profiler), resources=resources
+            )
+            coords = pds.read_lmpdata(str(path))
+            yield path.stem, pds, coords
+
+
+def _new_profiler(profiler):
+    return False if profiler is None else profiler.new()
+
+
+def compute_frame(pds, coords, mp=True, prescreen=False, method="bruteforce", cutoff=None, engine="homcloud", executor=None):
+    """
+    Compute PD_i, PD_i_cup_j and the threading of one frame.
+    """
+    pds.pd_i.compute(coords, dim=1, mp=mp, engine=engine, executor=executor)
+    pds.pd_i_cup_j.compute(coords, dim=1, mp=mp, prescreen=prescreen, cutoff=cutoff, engine=engine, executor=executor)
+    pds.threading.compute(pds.pd_i.diagrams, pds.pd_i_cup_j.diagrams, method=method)
+
+
+class FramePipeline:
+    """
+    Overlap reading, computing and writing of the frames of a batch.
+
+    The stages are connected by queues of at most queue_size frames, so a
+    fast reader cannot run ahead of the computation by more than that and
+    memory stays bounded. Each frame is written to <outputdir>/<name>.h5,
+    or appended to one TrajectoryFile when trajectory is given.
+
+    Usage:
+        with WorkerPool().start() as pool:  # ワーカーは pipeline のスレッドより先に起動する
+            pipeline = FramePipeline(outputdir, queue_size=2)
+            stats = pipeline.run(frames(files, pool))
+            print(stats["fps"])
+    """
+
+    def __init__(self, outputdir=".", compute=compute_frame, queue_size=2, max_fps=None, hdf5_options=None, trajectory=None):
+        """
+        args:
+            outputdir: str, directory of the HDF5 files
+            compute: callable(pds, coords), computes one frame in place
+            queue_size: int, maximum number of frames waiting between two stages
+            max_fps: float, upper limit of the throughput (frames per second), None for no limit
+            hdf5_options: dict, keyword arguments of HomologicalThreading.to_hdf5 (compression, ...)
+            trajectory: TrajectoryFile opened for appending, all frames are written to it
+        """
+        self.outputdir = pathlib.Path(outputdir)
+        self.compute = compute
+        self.queue_size = queue_size
+        self.max_fps = max_fps
+        self.hdf5_options = hdf5_options or {}
+        self.trajectory = trajectory
+        self.stats = None
+
+    def run(self, frames):
+        """
+        Run the pipeline over an iterable of (name, pds, coords).
+
+        return:
+            stats: dict
+                nframes: int, number of frames written
+                wall_time: float, seconds
+                fps: float, frames per second
+                busy: dict, time spent in each stage ("read", "compute", "write")
+        """
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        busy = {"read": 0.0, "compute": 0.0, "write": 0.0}
+        errors = []
+
+        def read():
+            try:
+                iterator = iter(frames)
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    item = next(iterator, _DONE)
+                    busy["read"] += time.perf_counter() - start
+                    if not _put(read_queue, item, stop) or item is _DONE:
+                        return
+            except BaseException as e:
+                errors.append(e)
+                _put(read_queue, _DONE, stop)
+
+        def write():
+            try:
+                while True:
+                    item = write_queue.get()
+                    if item is _DONE:
+                        return
+                    name, pds = item
+                    start = time.perf_counter()
+                    if self.trajectory is not None:
+                        self.trajectory.append(pds, name)
+                    else:
+                        pds.to_hdf5(self.outputdir / f"{name}.h5", **self.hdf5_options)
+                    busy["write"] += time.perf_counter() - start
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        reader = threading.Thread(target=read, name="pipeline-read", daemon=True)
+        writer = threading.Thread(target=write, name="pipeline-write", daemon=True)
+        nframes = 0
+        t0 = time.perf_counter()
+        reader.start()
+        writer.start()
+        try:
+            while True:
+                # 書き出しが失敗すると stop が立ち，読み込みスレッドは _DONE を入れずに終わるので待ち続けない
+                item = _get(read_queue, stop)
+                if item is _DONE:
+                    break
+                name, pds, coords = item
+                if self.max_fps:
+                    # 目標のスループットを超えないように待つ
+                    delay = t0 + (nframes + 1) / self.max_fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                start = time.perf_counter()
+                self.compute(pds, coords)
+                busy["compute"] += time.perf_counter() - start
+                if not _put(write_queue, (name, pds), stop):
+                    break
+                nframes += 1
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # 計算済みのフレームを書き出してから書き出しスレッドを終える
+            while writer.is_alive():
+                try:
+                    write_queue.put(_DONE, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            writer.join()
+            stop.set()
+            reader.join()
+        if errors:
+            raise errors[0]
+
+        wall_time = time.perf_counter() - t0
+        self.stats = {
+            "nframes": nframes,
+            "wall_time": wall_time,
+            "fps": nframes / wall_time if wall_time > 0 else 0.0,
+            "busy": busy,
+        }
+        return self.stats
+
+
+def _put(q, item, stop):
+    """
+    Put item into q, giving up when stop is set. Return True if it was put.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    """
+    Get an item from q, giving up when stop is set. Return _DONE if it gave up.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
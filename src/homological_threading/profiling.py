@@ -0,0 +1,199 @@
+"""
+Opt-in per-stage profiling.
+
+HomologicalThreading(profile=True) の各段階 (homcloud のフィルトレーション，結果の連結，
+Fortran の threading，HDF5 の書き出しなど) とワーカーの各タスクについて，
+経過時間，CPU 時間，最大 RSS と扱った要素 (チェイン，ペア) と点の数を記録する．
+profile=False の時は何もしない _NullProfiler を使うので，計算のコードは常に stage() を呼んでよい．
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+
+# 1 つの記録の項目
+FIELDS = ("stage", "pid", "tid", "wall", "cpu", "peak_rss", "items", "points")
+
+
+class Profiler:
+    """
+    Collector of per-stage and per-worker records.
+
+    A record is a dict with the keys of FIELDS: the name of the stage, the
+    process and thread ids, wall and CPU time in seconds (CPU time of the whole
+    process for a stage, of the worker thread for a worker task, see
+    task_stats), the peak resident set size of
+    the process in bytes, and the number of items (chains or pairs) and
+    points handled. Every record is also passed to the collectors, callables
+    taking the record, so users can forward them to their own tools.
+
+    Usage:
+        profiler = Profiler(collectors=[print])
+        pds = HomologicalThreading(profile=profiler)
+        ...
+        print(profiler.summary())
+
+    Attributes:
+        records: list of dict
+        collectors: list of callable(record)
+    """
+
+    enabled = True
+
+    def __init__(self, collectors=()):
+        self.records = []
+        self.collectors = list(collectors)
+
+    def new(self):
+        """Return an empty Profiler with the same collectors (e.g. one per frame)."""
+        return Profiler(self.collectors)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0, points=0):
+        """
+        Time the body of a with statement as one stage.
+        The yielded record can be updated inside the body (e.g. record["points"]).
+        """
+        record = {"stage": name, "pid": os.getpid(), "tid": threading.get_native_id(), "items": int(items), "points": int(points)}
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            record["peak_rss"] = peak_rss()
+            self.add(record)
+
+    def add(self, record):
+        """Add a record made elsewhere (e.g. by a worker, see task_stats)."""
+        # 計算側で NumPy の整数を入れても JSON にできるようにする
+        record["items"] = int(record["items"])
+        record["points"] = int(record["points"])
+        self.records.append(record)
+        for collector in self.collectors:
+            collector(record)
+
+    def summary(self):
+        """
+        Totals per stage and per worker (process, or thread of the thread executor).
+
+        return:
+            summary: dict
+                stages: dict, stage -> calls, wall, cpu, peak_rss (max), items, points
+                workers: dict, "pid:tid" (see worker_id) -> tasks, wall, cpu, peak_rss (max), items, points of the worker tasks
+        """
+        stages = {}
+        workers = {}
+        for record in self.records:
+            _accumulate(stages.setdefault(record["stage"], _empty("calls")), record, "calls")
+            if record["stage"].endswith(".worker"):
+                _accumulate(workers.setdefault("%d:%d" % worker_id(record), _empty("tasks")), record, "tasks")
+        return {"stages": stages, "workers": workers}
+
+    def to_json(self):
+        return json.dumps(self.summary())
+
+    def write(self, group):
+        """
+        Write all records to group["records"] as a compound dataset.
+        """
+        dtype = np.dtype(
+            [("stage", "S64"), ("pid", "i8"), ("tid", "i8"), ("wall", "f8"), ("cpu", "f8"), ("peak_rss", "i8"), ("items", "i8"), ("points", "i8")]
+        )
+        table = np.array([tuple(record[field] for field in FIELDS) for record in self.records], dtype=dtype)
+        group.create_dataset("records", data=table)
+
+
+class _NullProfiler:
+    """
+    Profiler that records nothing (profile=False).
+    """
+
+    enabled = False
+    records = ()
+
+    def new(self):
+        return self
+
+    def stage(self, name, items=0, points=0):
+        return contextlib.nullcontext({})
+
+    def add(self, record):
+        pass
+
+
+NULL = _NullProfiler()
+
+
+def as_profiler(profile):
+    """
+    Profiler for the profile argument of HomologicalThreading: a Profiler is used
+    as is, True makes a new one and False (None) disables profiling.
+    """
+    if isinstance(profile, (Profiler, _NullProfiler)):
+        return profile
+    return Profiler() if profile else NULL
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KiB, macOS は byte
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def task_clock():
+    """
+    (wall, cpu) at the start of a worker task, to pass to task_stats.
+    """
+    return time.perf_counter(), time.thread_time()
+
+
+def task_stats(stage, wall, cpu, items=0, points=0):
+    """
+    Record of a worker task started at task_clock() == (wall, cpu).
+
+    The CPU time is that of the calling thread: the workers of ThreadExecutor
+    share one process, and process_time() would count every worker in each task.
+    """
+    return {
+        "stage": stage,
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+        "wall": time.perf_counter() - wall,
+        "cpu": time.thread_time() - cpu,
+        "peak_rss": peak_rss(),
+        "items": int(items),
+        "points": int(points),
+    }
+
+
+def worker_id(record):
+    """
+    (pid, tid) of the worker that made a record; threads of one process are different workers.
+    """
+    return record["pid"], record["tid"]
+
+
+def _empty(count_key):
+    return {count_key: 0, "wall": 0.0, "cpu": 0.0, "peak_rss": 0, "items": 0, "points": 0}
+
+
+def _accumulate(total, record, count_key):
+    total[count_key] += 1
+    total["wall"] += record["wall"]
+    total["cpu"] += record["cpu"]
+    total["peak_rss"] = max(total["peak_rss"], record["peak_rss"])
+    total["items"] += record["items"]
+    total["points"] += record["points"]
@@ -0,0 +1,208 @@
+"""
+Resource planning: how the cores are split between workers and native threads.
+
+PD の計算はチェインやペアをワーカー (プロセスまたはスレッド) に分けて並列化し，
+Threading.compute とベッティ数は Fortran の OpenMP で並列化する．どちらも OMP_NUM_THREADS を
+そのまま使うと，コア数のワーカーの中でそれぞれコア数の OpenMP/BLAS スレッドが動いてしまう．
+ResourcePlanner は段階毎にコアの予算をワーカー数と 1 ワーカー当たりのスレッド数に分け，
+親プロセスではその段階の間だけ，ワーカーではタスクの最初にスレッド数を固定する．
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+# 段階毎の並列化の方法
+# "workers": ワーカーに分ける (各ワーカーのスレッド数は予算をワーカー数で割ったもの)
+# "threads": 親プロセスの OpenMP/BLAS スレッドで並列化する
+STAGES = {
+    "pd_i": "workers",
+    "pd_i_cup_j": "workers",
+    "ensemble": "workers",
+    "threading": "threads",
+    "betti": "threads",
+}
+
+# ワーカーで後から読み込まれるライブラリのスレッド数を決める環境変数
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS")
+
+
+def available_cores():
+    """Number of CPUs this process may run on (affinity mask), or the number of CPUs."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ResourcePlan:
+    """
+    Split of the core budget for one stage.
+
+    Attributes:
+        stage: str
+        cores: int, core budget
+        workers: int, number of workers (processes or threads) running at once
+        threads: int, OpenMP/BLAS threads of each worker
+    """
+
+    def __init__(self, stage, cores, workers, threads):
+        self.stage = stage
+        self.cores = cores
+        self.workers = workers
+        self.threads = threads
+
+    @property
+    def oversubscribed(self):
+        """True if more threads than cores run at once (a pool larger than the budget)."""
+        return self.workers * self.threads > self.cores
+
+    def as_dict(self):
+        return {"cores": self.cores, "workers": self.workers, "threads": self.threads}
+
+    def __repr__(self):
+        note = " (oversubscribed)" if self.oversubscribed else ""
+        return f"{self.stage}: {self.workers} workers x {self.threads} threads on {self.cores} cores{note}"
+
+
+class ResourcePlanner:
+    """
+    Plan of workers and native threads per stage within a core budget.
+
+    Usage:
+        pds = HomologicalThreading(resources=ResourcePlanner(cores=16))
+        pds.pd_i_cup_j.compute(coords, executor="process")  # 16 processes x 1 thread
+        pds.threading.compute(...)                         # 1 process x 16 OpenMP threads
+
+    The plans of the last call of each stage are kept in plans (and
+    HomologicalThreading.metadata["resource_plan"]). A new plan is logged to
+    the logger "homological_threading.resources" at INFO level, or WARNING
+    if the executor has more workers than the budget has cores.
+
+    Attributes:
+        cores: int, core budget (default: available_cores())
+        plans: dict, stage -> ResourcePlan
+    """
+
+    def __init__(self, cores=None):
+        self.cores = available_cores() if cores is None else max(int(cores), 1)
+        self.plans = {}
+
+    def plan(self, stage, workers=None, items=None):
+        """
+        Plan a stage.
+
+        args:
+            stage: str, key of STAGES
+            workers: int, number of workers of the executor (None: as many as cores)
+            items: int, number of tasks or items; no more workers than items are counted
+
+        return:
+            plan: ResourcePlan
+        """
+        if STAGES[stage] == "threads":
+            plan = ResourcePlan(stage, self.cores, 1, self.cores)
+        else:
+            workers = self.cores if workers is None else max(int(workers), 1)
+            if items is not None:
+                workers = max(min(workers, int(items)), 1)
+            plan = ResourcePlan(stage, self.cores, workers, max(self.cores // workers, 1))
+        # 同じ計画を毎フレーム出力しないように，変わった時だけ出力する
+        if stage not in self.plans or self.plans[stage].as_dict() != plan.as_dict():
+            logger.log(logging.WARNING if plan.oversubscribed else logging.INFO, "resource plan %r", plan)
+        self.plans[stage] = plan
+        return plan
+
+    @contextlib.contextmanager
+    def limit(self, stage, workers=None, items=None):
+        """
+        Plan a stage and limit the native threads of this process to plan.threads
+        during the body of a with statement. Yields the plan.
+        """
+        plan = self.plan(stage, workers, items)
+        with limit_threads(plan.threads):
+            yield plan
+
+    def to_json(self):
+        return json.dumps({stage: plan.as_dict() for stage, plan in self.plans.items()})
+
+
+@contextlib.contextmanager
+def limit_threads(n):
+    """
+    Limit the OpenMP threads of the Fortran module and the BLAS/OpenMP thread
+    pools (threadpoolctl, if installed) of this process to n, and restore them
+    afterwards.
+    """
+    global _parallel_openmp
+    fc = _fortran(load=True)
+    previous = fc.max_threads()
+    fc.set_num_threads(n)
+    _parallel_openmp = _parallel_openmp or n > 1
+    try:
+        with _threadpool_limits(n):
+            yield
+    finally:
+        fc.set_num_threads(previous)
+
+
+# このプロセスで 2 スレッド以上の OpenMP の並列区間を動かしたか (limit_threads)
+_parallel_openmp = False
+
+
+def fork_safe():
+    """
+    False once this process has run OpenMP with more than one thread: GNU OpenMP
+    hangs in a child forked after that, so WorkerPool starts its workers with forkserver.
+    """
+    return not _parallel_openmp
+
+
+# ワーカーで最後に固定したスレッド数
+_pinned = None
+
+
+def pin_threads(n):
+    """
+    Fix the native threads of a worker process to n for the rest of its life.
+
+    Called at the start of every task with the plan of its stage; does nothing
+    if the worker is already pinned to n.
+    """
+    global _pinned
+    if n is None or n == _pinned:
+        return
+    # まだ読み込まれていないライブラリは環境変数から，読み込み済みのものは直接設定する
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(n)
+    fc = _fortran()
+    if fc is not None:
+        fc.set_num_threads(n)
+    # 戻さずにワーカーの終了まで有効にする
+    _threadpool_limits(n).__enter__()
+    _pinned = n
+
+
+def _fortran(load=False):
+    """
+    The Fortran module. Unless load=True, None if it is not loaded yet: a worker
+    that never runs Fortran does not import it only to set its threads.
+    """
+    if not load and f"{__package__}.fortran.compute" not in sys.modules:
+        return None
+    from .fortran import compute as fc
+
+    return fc
+
+
+def _threadpool_limits(n):
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        # threadpoolctl が無ければ BLAS のスレッド数は環境変数にまかせる
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=n)
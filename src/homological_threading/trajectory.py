@@ -0,0 +1,352 @@
+"""
+Multi-frame HDF5 container.
+
+トラジェクトリの全フレームを 1 つの HDF5 ファイルに追記していく．
+各 PD のグループの points, offsets はフレームを跨いで 1 本の配列に繋げ，
+index, threading/flags はフレームの次元を持つ配列にする．
+フレーム k のセグメントは frame_segments[k]:frame_segments[k + 1] の範囲．
+
+Layout:
+    /Metadata                    attrs, フレームによらないメタデータ (最初のフレームのもの)
+    /frames/name                 (nframes) フレームの名前
+    /frames/<key>                (nframes) フレーム毎に変わるメタデータ (FRAME_KEYS)
+    /<pd>/points                 (total_points, 2)
+    /<pd>/offsets                (total_segments + 1)
+    /<pd>/index                  (nframes, *cell_shape)
+    /<pd>/frame_segments         (nframes + 1)
+    /threading/flags             (nframes, nchains, nchains)
+<pd> は pd_i, pd_i_cup_j, threading．
+"""
+
+import numpy as np
+
+from .diagram import LazyRaggedPD, RaggedPD, filter_options
+from .main import HomologicalThreading
+
+# PD のグループ名と HomologicalThreading の属性名
+GROUPS = ("pd_i", "pd_i_cup_j", "threading")
+
+# フレーム毎に保存するメタデータと型．それ以外のメタデータは /Metadata に 1 回だけ保存する
+FRAME_KEYS = {
+    "timestamp": "str",
+    "source": "str",
+    "timestep": "int",
+    "threading_threshold": "float",
+    "n_pairs_pruned": "int",
+    "worker_utilization": "array",
+    "cache_hit_rate_pd_i": "float",
+    "cache_hit_rate_pd_i_cup_j": "float",
+    "profile": "str",
+    "pair_points_removed": "float",
+    "resource_plan": "str",
+}
+
+
+class TrajectoryFile:
+    """
+    Appendable HDF5 file holding the results of many frames.
+
+    Frames are appended one at a time while a trajectory is being
+    processed; each append() resizes the datasets and flushes the file.
+    The number of frames is the length of /frames/name, which is written
+    last, so a frame interrupted in the middle of append() is discarded
+    when the file is opened again.
+
+    Usage:
+        with TrajectoryFile("traj.h5", "a") as traj:
+            for coords in pds.iter_lmpdump("traj.dump"):
+                ...
+                traj.append(pds)
+        with TrajectoryFile("traj.h5", "r") as traj:
+            for pds in traj.frames(100, 200, lazy=True):
+                n_a, n_p = pds.threading.num_threading()
+
+    Attributes:
+        filename: str
+        names: list of str, names of the frames
+    """
+
+    def __init__(self, filename, mode="a", compression="gzip", compression_opts=4, shuffle=True):
+        """
+        args:
+            filename: str
+            mode: str, "r" (read only), "a" (append, create if missing) or "w" (overwrite)
+            compression, compression_opts, shuffle: filters of the datasets, see RaggedPD.write
+        """
+        self.filename = str(filename)
+        self.mode = mode
+        self._options = filter_options(compression, compression_opts, shuffle)
+        import h5py
+
+        self._file = h5py.File(self.filename, mode)
+        if mode != "r" and "frames" in self._file:
+            self._truncate(len(self))
+
+    def __len__(self):
+        if "frames" not in self._file:
+            return 0
+        return len(self._file["frames/name"])
+
+    @property
+    def names(self):
+        if "frames" not in self._file:
+            return []
+        return list(self._file["frames/name"].asstr()[:])
+
+    def append(self, pds, name=None):
+        """
+        Append the diagrams, flags and metadata of one frame.
+
+        args:
+            pds: HomologicalThreading
+            name: str, name of the frame (defaults to the frame number)
+
+        return:
+            k: int, frame number
+        """
+        f = self._file
+        k = len(self)
+        if "frames" not in f:
+            self._create(pds)
+        # 最初のフレームに無かったグループは追記できない
+        for group in GROUPS:
+            if getattr(pds, group).diagrams is not None and group not in f:
+                raise ValueError(f"{group} is not stored in {self.filename}")
+        if pds.threading.flags is not None and "threading/flags" not in f:
+            raise ValueError(f"threading/flags is not stored in {self.filename}")
+
+        for group in GROUPS:
+            if group in f:
+                _append_diagrams(f[group], k, getattr(pds, group).diagrams)
+        if "threading/flags" in f:
+            flags = f["threading/flags"]
+            flags.resize(k + 1, axis=0)
+            if pds.threading.flags is not None:
+                flags[k] = pds.threading.flags
+
+        frames = f["frames"]
+        for key, kind in FRAME_KEYS.items():
+            if key not in frames:
+                # 後から追加された項目: それまでのフレームは欠損値にする
+                frames.create_dataset(key, data=[_encode(None, kind)] * k, maxshape=(None,), dtype=_dtype(kind))
+            dataset = frames[key]
+            dataset.resize(k + 1, axis=0)
+            dataset[k] = _encode(pds.metadata.get(key), kind)
+        # name を最後に書く: これでフレームが確定する
+        frames["name"].resize(k + 1, axis=0)
+        frames["name"][k] = str(k) if name is None else str(name)
+        f.flush()
+        return k
+
+    def read(self, frame, lazy=False, pds=None):
+        """
+        Read one frame.
+
+        args:
+            frame: int, frame number (negative numbers count from the end)
+            lazy: bool, read the points of the diagrams on demand (see LazyRaggedPD).
+                The diagrams can only be used while this file is open.
+            pds: HomologicalThreading to fill, a new one by default
+
+        return:
+            pds: HomologicalThreading
+        """
+        nframes = len(self)
+        if frame < 0:
+            frame += nframes
+        if not 0 <= frame < nframes:
+            raise IndexError(f"Frame {frame} is out of range ({nframes} frames)")
+        if pds is None:
+            pds = HomologicalThreading()
+        f = self._file
+        for key, value in f["Metadata"].attrs.items():
+            pds.metadata[key] = None if isinstance(value, str) and value == "None" else value
+        for key, kind in FRAME_KEYS.items():
+            if key in f["frames"]:
+                pds.metadata[key] = _decode(f["frames"][key][frame], kind)
+        for group in GROUPS:
+            if group in f:
+                getattr(pds, group).diagrams = _read_diagrams(f[group], frame, lazy)
+        if "threading/flags" in f:
+            pds.threading.flags = f["threading/flags"][frame]
+        return pds
+
+    def frames(self, start=0, stop=None, step=1, lazy=False):
+        """
+        Iterate over a range of frames.
+
+        yield:
+            pds: HomologicalThreading of each frame
+        """
+        for k in range(*slice(start, stop, step).indices(len(self))):
+            yield self.read(k, lazy=lazy)
+
+    def __iter__(self):
+        return self.frames()
+
+    def _create(self, pds):
+        """
+        Create the datasets from the first frame.
+        """
+        f = self._file
+        f.create_group("Metadata")
+        for key, value in pds.metadata.items():
+            if key not in FRAME_KEYS:
+                f["Metadata"].attrs[key] = "None" if value is None else value
+        frames = f.create_group("frames")
+        frames.create_dataset("name", shape=(0,), maxshape=(None,), dtype=_dtype("str"))
+        for key, kind in FRAME_KEYS.items():
+            frames.create_dataset(key, shape=(0,), maxshape=(None,), dtype=_dtype(kind))
+
+        for group in GROUPS:
+            diagrams = getattr(pds, group).diagrams
+            if diagrams is None:
+                continue
+            g = f.create_group(group)
+            cell_shape = diagrams.cell_shape
+            g.create_dataset(
+                "points", shape=(0, 2), maxshape=(None, 2), dtype=np.float64,
+                chunks=(diagrams.chunk_rows(), 2), **self._options,
+            )
+            g.create_dataset(
+                "offsets", data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=(1 << 16,), **self._options
+            )
+            g.create_dataset(
+                "index", shape=(0,) + cell_shape, maxshape=(None,) + cell_shape, dtype=np.int64,
+                chunks=(1,) + _row_chunks(cell_shape), **self._options,
+            )
+            g.create_dataset(
+                "frame_segments", data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=(1 << 12,)
+            )
+        flags = pds.threading.flags
+        if flags is not None:
+            g = f.require_group("threading")
+            g.create_dataset(
+                "flags", shape=(0,) + flags.shape, maxshape=(None,) + flags.shape, dtype=bool,
+                chunks=(1,) + _row_chunks(flags.shape), **self._options,
+            )
+
+    def _truncate(self, nframes):
+        """
+        Drop the data of frames after nframes (left by an interrupted append).
+        """
+        f = self._file
+        for group in GROUPS:
+            if group not in f:
+                continue
+            g = f[group]
+            nsegments = int(g["frame_segments"][nframes])
+            g["frame_segments"].resize(nframes + 1, axis=0)
+            g["index"].resize(nframes, axis=0)
+            g["offsets"].resize(nsegments + 1, axis=0)
+            g["points"].resize(int(g["offsets"][nsegments]), axis=0)
+        if "threading/flags" in f:
+            f["threading/flags"].resize(nframes, axis=0)
+        for key in FRAME_KEYS:
+            if key in f["frames"]:
+                f["frames"][key].resize(nframes, axis=0)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_trajectory(filename):
+    """
+    Return True if filename is a TrajectoryFile (not a single-frame result file).
+    """
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        return "frames" in f
+
+
+def _append_diagrams(group, k, diagrams):
+    """
+    Append the diagrams of frame k to a group (diagrams=None: empty frame).
+    """
+    nsegments = group["offsets"].shape[0] - 1
+    frame_segments = group["frame_segments"]
+    frame_segments.resize(k + 2, axis=0)
+    index = group["index"]
+    index.resize(k + 1, axis=0)
+    if diagrams is None:
+        index[k] = -1
+        frame_segments[k + 1] = nsegments
+        return
+    if diagrams.cell_shape != index.shape[1:]:
+        raise ValueError(f"Cell shape {diagrams.cell_shape} does not match {index.shape[1:]}")
+    points = group["points"]
+    offsets = group["offsets"]
+    npoints = points.shape[0]
+    points.resize(npoints + len(diagrams.points), axis=0)
+    points[npoints:] = diagrams.points
+    offsets.resize(nsegments + 1 + diagrams.nsegments, axis=0)
+    offsets[nsegments + 1 :] = diagrams.offsets[1:] + npoints
+    index[k] = diagrams.index
+    frame_segments[k + 1] = nsegments + diagrams.nsegments
+
+
+def _read_diagrams(group, k, lazy):
+    """
+    Read the diagrams of frame k from a group.
+    """
+    s0, s1 = group["frame_segments"][k : k + 2]
+    offsets = group["offsets"][s0 : s1 + 1]
+    index = group["index"][k]
+    if lazy:
+        return LazyRaggedPD(group["points"], offsets, index)
+    points = group["points"][offsets[0] : offsets[-1]]
+    return RaggedPD(points, offsets - offsets[0], index)
+
+
+def _row_chunks(shape, target=1 << 16):
+    """
+    Chunk shape of one frame of a (nchains, ...) array: whole rows, about target elements.
+    """
+    if len(shape) == 0:
+        return ()
+    row = int(np.prod(shape[1:], dtype=np.int64))
+    nrows = min(max(target // max(row, 1), 1), max(shape[0], 1))
+    return (nrows,) + tuple(max(n, 1) for n in shape[1:])
+
+
+def _dtype(kind):
+    """HDF5 の型 (h5py は使う時に読み込む)．"""
+    import h5py
+
+    return {
+        "str": h5py.string_dtype(),
+        "int": np.int64,
+        "float": np.float64,
+        "array": h5py.vlen_dtype(np.float64),
+    }[kind]
+
+
+def _encode(value, kind):
+    """None を各型の欠損値に置き換える．"""
+    if kind == "str":
+        return "None" if value is None else str(value)
+    if kind == "int":
+        return -1 if value is None else int(value)
+    if kind == "float":
+        return np.nan if value is None else float(value)
+    return np.zeros(0) if value is None else np.asarray(value, dtype=np.float64).ravel()
+
+
+def _decode(value, kind):
+    if kind == "str":
+        value = value.decode() if isinstance(value, bytes) else value
+        return None if value == "None" else value
+    if kind == "int":
+        return None if value < 0 else int(value)
+    if kind == "float":
+        return None if np.isnan(value) else float(value)
+    return None if len(value) == 0 else np.asarray(value)
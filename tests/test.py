@@ -1,11 +1,11 @@
-import matplotlib.pyplot as plt
 import sys
 import pathlib
 import time
 import argparse
+import tempfile
+import threading
 import numpy as np
 import os
-import h5py
 
 sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent / "src"))
 
@@ -44,7 +44,7 @@ def test(filename, output):
     
     # Compute threading
     time_threading_start = time.time()
-    pds.threading.compute(pds.pd_i.pd, pds.pd_i_cup_j.pd)
+    pds.threading.compute(pds.pd_i.diagrams, pds.pd_i_cup_j.diagrams)
     time_threading_end = time.time()
     print(f"Elapsed time for computing threading: {time_threading_end - time_threading_start:.2f} seconds")
     
@@ -80,6 +80,21 @@ def test(filename, output):
     pds.to_hdf5(output)
     print(f"Results saved to {output}")
     
+    # 各チェックの結果．1 つでも False なら実行全体を失敗にする (failed_checks)
+    checks = {
+        "polyWrap reference": check_polywrap_reference(filename, coords),
+        "threading methods": check_threading_methods(pds),
+        "threading methods on long diagrams": check_threading_methods_long(),
+        "pair cutoff": check_pair_cutoff(pds, coords),
+        "frame cache": check_frame_cache(coords),
+        "disk cache": check_disk_cache(pds, coords),
+        "builtin engine": check_builtin_engine(pds, coords),
+        "trajectory": check_trajectory(pds),
+        "pipeline write error": check_pipeline_write_error(),
+        "lammps dump": check_lammps_dump(),
+        "shared memory release": check_shared_memory_release(coords),
+    }
+
     # Calculate Betti numbers using the class methods
     alphas_i, betti_i = pds.pd_i.betti()
     alphas_i_cup_j, betti_i_cup_j = pds.pd_i_cup_j.betti()
@@ -88,9 +103,503 @@ def test(filename, output):
     return {
         "pd_i": (alphas_i, betti_i),
         "pd_i_cup_j": (alphas_i_cup_j, betti_i_cup_j),
-        "threading": (alphas_threading, betti_threading)
+        "threading": (alphas_threading, betti_threading),
+        "checks": checks,
+    }
+
+
+def failed_checks(result):
+    """
+    Names of the checks of a test() result that did not pass.
+
+    args:
+    result: dict
+        Return value of test().
+
+    returns:
+    list of str: names of the failed checks, empty if all passed.
+    """
+    return [name for name, ok in result["checks"].items() if not ok]
+
+
+# polyWrap をベクトル化する前の関数で data/N10M100.data をラップした座標の SHA-256
+POLYWRAP_REFERENCE = {
+    "N10M100.data": "a0befb52db5a4d3e21a3eb3a7ff64bf74b09b1d54b2735e9804b631e7fd4d2ba",
+}
+
+
+def check_polywrap_reference(filename, coords):
+    """
+    Check that the wrapped coordinates are bit-identical to the reference of
+    the original (per-molecule loop) polyWrap.
+
+    args:
+    filename: str
+        Input LAMMPS data file.
+    coords: np.array
+        Coordinates returned by read_lmpdata.
+
+    returns:
+    bool: True if the checksum matches or no reference is known for the file.
+    """
+    import hashlib
+
+    reference = POLYWRAP_REFERENCE.get(pathlib.Path(filename).name)
+    if reference is None:
+        print(f"No polyWrap reference for {filename}")
+        return True
+    digest = hashlib.sha256(np.ascontiguousarray(coords, dtype=np.float64).tobytes()).hexdigest()
+    ok = digest == reference
+    print(f"polyWrap matches the reference: {ok}")
+    return ok
+
+
+def check_threading_methods(pds):
+    """
+    Check that the birth-sorted matching gives the same threading as the brute-force reference.
+
+    args:
+    pds: HomologicalThreading
+        Instance with pd_i and pd_i_cup_j computed.
+
+    returns:
+    bool: True if both methods agree, False otherwise.
+    """
+    results = {}
+    for method in ["bruteforce", "sorted"]:
+        time_start = time.time()
+        pds.threading.compute(pds.pd_i.diagrams, pds.pd_i_cup_j.diagrams, method=method)
+        print(f"Elapsed time for threading ({method}): {time.time() - time_start:.4f} seconds")
+        results[method] = (pds.threading.flags, pds.threading.diagrams.points, pds.threading.diagrams.offsets)
+    same = all(
+        np.array_equal(a, b) for a, b in zip(results["bruteforce"], results["sorted"])
+    )
+    print(f"Threading methods agree: {same}")
+    return same
+
+
+def check_threading_methods_long(nchains=20, npoints=320, seed=0):
+    """
+    Check both threading methods on synthetic diagrams long enough for the sorted matching to win.
+
+    Each PD_i_cup_j cell holds 90% of the points of PD_i of the passive chain
+    (shuffled), PD_i of the active chain and a few new points.
+
+    args:
+    nchains: int
+        Number of chains.
+    npoints: int
+        Number of points of each PD_i.
+    seed: int
+        Seed of the random diagrams.
+
+    returns:
+    bool: True if both methods agree, False otherwise.
+    """
+    rng = np.random.default_rng(seed)
+    pd_i = [np.sort(rng.random((npoints, 2)), axis=1) for _ in range(nchains)]
+    cells = []
+    for i in range(nchains):
+        for j in range(nchains):
+            if i == j:
+                cells.append(np.zeros((0, 2)))
+                continue
+            kept = pd_i[i][rng.random(npoints) < 0.9]
+            cells.append(rng.permutation(np.concatenate([kept, pd_i[j], rng.random((npoints // 10, 2))])))
+    pds = ht.HomologicalThreading()
+    pds.pd_i.diagrams = ht.RaggedPD.from_list(pd_i)
+    pds.pd_i_cup_j.diagrams = ht.RaggedPD.from_list(cells, index=np.arange(nchains * nchains).reshape(nchains, nchains))
+    print(f"Synthetic diagrams: {nchains} chains, {npoints} points per chain")
+    return check_threading_methods(pds)
+
+
+def check_pair_cutoff(pds, coords, cutoff=1.5):
+    """
+    Check that restricting the pairs to the beads within a cutoff gives the same threading flags.
+
+    args:
+    pds: HomologicalThreading
+        Instance with pd_i, pd_i_cup_j and threading computed without a cutoff.
+    coords: np.array
+        Coordinates of the chains, shape=(nchains, nbeads, 3).
+    cutoff: float
+        Distance passed to PD_i_cup_j.compute.
+
+    returns:
+    bool: True if the flags agree, False otherwise.
+    """
+    restricted = ht.HomologicalThreading()
+    restricted.pd_i.diagrams = pds.pd_i.diagrams
+    time_start = time.time()
+    restricted.pd_i_cup_j.compute(coords, dim=1, mp=False, cutoff=cutoff)
+    print(f"Elapsed time for computing pd_i_cup_j (cutoff {cutoff}): {time.time() - time_start:.2f} seconds")
+    restricted.threading.compute(restricted.pd_i.diagrams, restricted.pd_i_cup_j.diagrams)
+    removed = restricted.pd_i_cup_j.removed
+    nbeads = coords.shape[1]
+    print(
+        f"Beads of chain j removed per pair: mean {removed.mean():.2f} / {nbeads}"
+        f" (min {removed.min()}, max {removed.max()}, {np.mean(removed == nbeads) * 100:.1f}% of pairs reduced to chain i)"
+    )
+    same = np.array_equal(restricted.threading.flags, pds.threading.flags)
+    print(f"Threading flags with cutoff agree: {same}")
+    return same
+
+
+def check_frame_cache(coords, moved=(0, 3), seed=0):
+    """
+    Check that FrameCache gives the same diagrams and flags as computing every frame from scratch.
+
+    Two frames are computed with a cache of tolerance 0: the second moves the beads of
+    the chains in moved, so only those chains and their pairs are recomputed. The same
+    coordinates are then computed with two cutoffs in turn: the pairs computed with the
+    first cutoff must not be reused for the second. The builtin engine keeps the check short.
+
+    args:
+    coords: np.array
+        Coordinates of the chains, shape=(nchains, nbeads, 3).
+    moved: tuple of int
+        Chains moved in the second frame.
+    seed: int
+        Seed of the displacements.
+
+    returns:
+    bool: True if the cached and the full computations agree, False otherwise.
+    """
+    rng = np.random.default_rng(seed)
+    second = coords.copy()
+    second[list(moved)] += rng.normal(scale=0.05, size=second[list(moved)].shape)
+
+    def run(frame, cache=None, cutoff=None):
+        pds = ht.HomologicalThreading(cache=cache)
+        pds.pd_i.compute(frame, dim=1, mp=False, engine="builtin")
+        pds.pd_i_cup_j.compute(frame, dim=1, mp=False, engine="builtin", cutoff=cutoff)
+        pds.threading.compute(pds.pd_i.diagrams, pds.pd_i_cup_j.diagrams)
+        return pds
+
+    def same(a, b):
+        return np.array_equal(a.threading.flags, b.threading.flags) and all(
+            np.array_equal(getattr(a, g).diagrams.select(), getattr(b, g).diagrams.select())
+            and np.array_equal(getattr(a, g).diagrams.counts, getattr(b, g).diagrams.counts)
+            for g in ("pd_i", "pd_i_cup_j", "threading")
+        )
+
+    cache = ht.FrameCache(tolerance=0.0)
+    run(coords, cache)
+    cached = run(second, cache)
+    hit_rate = cached.metadata["cache_hit_rate_pd_i_cup_j"]
+    ok = hit_rate > 0 and same(cached, run(second))
+    run(second, cache, cutoff=3.0)
+    cached_cutoff = run(second, cache, cutoff=1.5)
+    ok_cutoff = same(cached_cutoff, run(second, cutoff=1.5))
+    print(f"Frame cache agrees with full computation: {ok} (pair hit rate {hit_rate:.2f}), after changing the cutoff: {ok_cutoff}")
+    return ok and ok_cutoff
+
+
+def check_disk_cache(pds, coords):
+    """
+    Check that DiagramCache returns the stored diagrams of the same engine only,
+    and that it evicts the least recently used entries.
+
+    args:
+    pds: HomologicalThreading
+        Instance with pd_i computed by HomCloud.
+    coords: np.array
+        Coordinates of the chains, shape=(nchains, nbeads, 3).
+
+    returns:
+    bool: True if every check passes, False otherwise.
+    """
+    nchains = len(coords)
+    with tempfile.TemporaryDirectory() as directory:
+        with ht.DiagramCache(os.path.join(directory, "diagrams.sqlite")) as cache:
+            results = []
+            for engine in ("builtin", "builtin", "homcloud"):
+                cached = ht.HomologicalThreading(disk_cache=cache)
+                hits = cache.hits
+                cached.pd_i.compute(coords, dim=1, mp=False, engine=engine)
+                results.append((cache.hits - hits, cached.pd_i.diagrams))
+            # 2 回目は 1 回目の結果を全て読み，homcloud は builtin の結果を読まない
+            # (HomCloud は実行毎に最後の桁が変わりうるので，homcloud の結果は許容誤差で比べる)
+            round_trip = (
+                results[0][0] == 0 and results[1][0] == nchains and results[2][0] == 0
+                and np.array_equal(results[0][1].points, results[1][1].points)
+                and np.allclose(results[2][1].points, pds.pd_i.diagrams.points, rtol=1e-12, atol=0)
+            )
+
+        # 160 バイトの PD 3 つに対して上限 400 バイト: a を読んだ後に c を入れると b が消える
+        pd = np.zeros((10, 2))
+        with ht.DiagramCache(os.path.join(directory, "lru.sqlite"), max_bytes=400) as cache:
+            for key in ("a", "b"):
+                cache.put_many([(key, pd)])
+                time.sleep(0.01)
+            cache.get_many(["a"])
+            time.sleep(0.01)
+            cache.put_many([("c", pd)])
+            eviction = sorted(cache.get_many(["a", "b", "c"])) == ["a", "c"] and cache.info()["bytes"] == 320
+    print(f"Disk cache round trip per engine: {round_trip}, LRU eviction: {eviction}")
+    return round_trip and eviction
+
+
+def check_lammps_dump(nframes=3, nmols=4, nbeads=6, seed=0):
+    """
+    Check the LammpsDump reader on small dumps written with the atoms in random order.
+
+    The same unwrapped trajectory is written with the xu / x + ix / x / xs columns.
+    Every variant must give the molecules of the trajectory moved into the cell by
+    their centres of mass, dump[k] must equal the k-th frame of the iteration, and
+    reopening with the .npy index must not rescan the dump.
+
+    args:
+    nframes: int
+        Number of frames to write.
+    nmols, nbeads: int
+        Number of molecules and atoms per molecule.
+    seed: int
+        Seed of the random trajectory.
+
+    returns:
+    bool: True if every check passes, False otherwise.
+    """
+    from homological_threading.lammps_io import wrap_com
+
+    rng = np.random.default_rng(seed)
+    lo = np.array([-5.0, 0.0, 2.0])
+    L = np.array([10.0, 8.0, 12.0])
+    # 結合長 1 のランダムウォークをセルの外にはみ出すように置く
+    steps = rng.normal(size=(nframes, nmols, nbeads, 3))
+    steps /= np.linalg.norm(steps, axis=-1, keepdims=True)
+    unwrapped = lo + rng.uniform(-1, 2, size=(nframes, nmols, 1, 3)) * L + steps.cumsum(axis=2)
+    expected = [wrap_com(u, lo, L) for u in unwrapped]
+
+    variants = {
+        "xu": "xu yu zu",
+        "x+ix": "x y z ix iy iz",
+        "xs+ix": "xs ys zs ix iy iz",
+        "x": "x y z",
+        "xs": "xs ys zs",
     }
 
+    def columns(u, variant):
+        image = np.floor((u - lo) / L)
+        x = u - image * L
+        if variant == "xu":
+            return u
+        scaled = (x - lo) / L if variant.startswith("xs") else x
+        return np.hstack([scaled, image]) if variant.endswith("ix") else scaled
+
+    def write(path, variant):
+        mol = np.repeat(np.arange(1, nmols + 1), nbeads)
+        ids = np.arange(1, nmols * nbeads + 1)
+        with open(path, "w") as f:
+            for k, u in enumerate(unwrapped):
+                rows = np.column_stack([ids, mol, columns(u.reshape(-1, 3), variant)])
+                f.write(f"ITEM: TIMESTEP\n{1000 * k}\nITEM: NUMBER OF ATOMS\n{len(rows)}\n")
+                f.write("ITEM: BOX BOUNDS pp pp pp\n")
+                f.writelines(f"{a!r} {b!r}\n" for a, b in zip(lo.tolist(), (lo + L).tolist()))
+                f.write(f"ITEM: ATOMS id mol {variants[variant]}\n")
+                # 原子の順番をフレーム毎に入れ替える
+                for row in rows[rng.permutation(len(rows))]:
+                    f.write(" ".join(repr(float(v)) for v in row) + "\n")
+
+    class NoScan(ht.LammpsDump):
+        def _scan_offsets(self):
+            raise RuntimeError("index was not reused")
+
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        for variant in variants:
+            path = os.path.join(directory, f"{variant}.dump")
+            index = os.path.join(directory, f"{variant}.npy")
+            write(path, variant)
+            dump = ht.LammpsDump(path, index_file=index)
+            frames = list(dump)
+            same = len(dump) == nframes and all(
+                np.allclose(c, e, rtol=0, atol=1e-9) for c, e in zip(frames, expected)
+            )
+            indexed = all(np.array_equal(dump[k], frames[k]) for k in range(nframes))
+            indexed &= dump.timestep == 1000 * (nframes - 1)
+            indexed &= all(np.array_equal(c, frames[k]) for c, k in zip(dump.frames(1, None, 2), range(1, nframes, 2)))
+            try:
+                reused = np.array_equal(NoScan(path, index_file=index).offsets, dump.offsets)
+            except RuntimeError:
+                reused = False
+            print(f"LammpsDump {variant}: coords {same}, dump[k] {indexed}, index reused {reused}")
+            ok &= same and indexed and reused
+    return ok
+
+
+def check_shared_memory_release(coords, nchains=10):
+    """
+    Check that the workers of a WorkerPool close the shared memory of the
+    coordinates when their tasks finish.
+
+    args:
+    coords: np.array
+        Coordinates of the chains; the first nchains are used.
+    nchains: int
+        Number of chains to compute.
+
+    returns:
+    bool: True if no worker maps a shared memory segment after the compute.
+    """
+    with ht.WorkerPool(2) as pool:
+        pds = ht.HomologicalThreading(pool=pool)
+        pds.pd_i.compute(coords[:nchains], dim=1, mp=True, engine="builtin")
+        pds.pd_i_cup_j.compute(coords[:nchains], dim=1, mp=True, engine="builtin")
+        # multiprocessing.shared_memory の名前は psm_ で始まる
+        mapped = []
+        for process in pool.pool._pool:
+            with open(f"/proc/{process.pid}/maps") as f:
+                mapped += [line.split()[5] for line in f if "/psm_" in line]
+    ok = not mapped
+    print(f"Workers release the shared memory: {ok}" + ("" if ok else f" ({mapped})"))
+    return ok
+
+
+def check_builtin_engine(pds, coords, pairs=((0, 1), (2, 7), (4, 9)), rtol=1e-12):
+    """
+    Check that the builtin alpha engine gives the HomCloud diagrams point for point.
+
+    args:
+    pds: HomologicalThreading
+        Instance with pd_i and pd_i_cup_j computed by HomCloud without a cutoff.
+    coords: np.array
+        Coordinates of the chains, shape=(nchains, nbeads, 3).
+    pairs: list of (int, int)
+        Chain pairs whose PD_i_cup_j is compared.
+    rtol: float
+        Relative tolerance of the births and deaths.
+
+    returns:
+    bool: True if every compared diagram agrees, False otherwise.
+    """
+    def same(a, b):
+        a = a[np.lexsort((a[:, 1], a[:, 0]))]
+        b = b[np.lexsort((b[:, 1], b[:, 0]))]
+        return a.shape == b.shape and np.allclose(a, b, rtol=rtol, atol=0)
+
+    builtin = ht.HomologicalThreading()
+    time_start = time.time()
+    builtin.pd_i.compute(coords, dim=1, mp=False, engine="builtin")
+    print(f"Elapsed time for computing pd_i (builtin): {time.time() - time_start:.2f} seconds")
+    nchains = len(coords)
+    same_i = all(same(builtin.pd_i.diagrams[i], pds.pd_i.diagrams[i]) for i in range(nchains))
+    same_pairs = all(
+        same(ht.alpha.alpha_h1(np.concatenate([coords[i], coords[j]])), pds.pd_i_cup_j.diagrams[i, j])
+        for i, j in pairs
+        if max(i, j) < nchains
+    )
+    print(f"Builtin engine agrees with HomCloud: pd_i {same_i}, pd_i_cup_j {same_pairs}")
+    return same_i and same_pairs
+
+
+def check_trajectory(pds, nframes=3):
+    """
+    Check that frames appended to a TrajectoryFile read back like to_hdf5/from_hdf5,
+    and that reopening drops a half-written frame.
+
+    Frame k holds the diagrams of pds with the points scaled by k + 1 and the flags
+    rolled by k, so every frame differs.
+
+    args:
+    pds: HomologicalThreading
+        Instance with pd_i, pd_i_cup_j and threading computed.
+    nframes: int
+        Number of frames to append.
+
+    returns:
+    bool: True if every check passes, False otherwise.
+    """
+    import h5py
+
+    groups = ("pd_i", "pd_i_cup_j", "threading")
+
+    def frame(k):
+        result = ht.HomologicalThreading()
+        result.metadata.update(pds.metadata)
+        for group in groups:
+            d = getattr(pds, group).diagrams
+            getattr(result, group).diagrams = ht.RaggedPD(d.points * (k + 1), d.offsets, d.index)
+        result.threading.flags = np.roll(pds.threading.flags, k, axis=1)
+        return result
+
+    def same(a, b):
+        return np.array_equal(a.threading.flags, b.threading.flags) and all(
+            np.array_equal(getattr(a, g).diagrams.select(), getattr(b, g).diagrams.select())
+            and np.array_equal(getattr(a, g).diagrams.counts, getattr(b, g).diagrams.counts)
+            for g in groups
+        )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "traj.h5")
+        references = []
+        with ht.TrajectoryFile(path, "w") as traj:
+            for k in range(nframes):
+                traj.append(frame(k), name=f"frame{k}")
+                single = os.path.join(directory, f"frame{k}.h5")
+                frame(k).to_hdf5(single)
+                reference = ht.HomologicalThreading()
+                reference.from_hdf5(single)
+                references.append(reference)
+
+        with ht.TrajectoryFile(path, "r") as traj:
+            ok = len(traj) == nframes and traj.names == [f"frame{k}" for k in range(nframes)]
+            for k in range(nframes):
+                ok &= same(references[k], traj.read(k)) and same(references[k], traj.read(k, lazy=True))
+        print(f"Trajectory round trip: {ok}")
+
+        # 最後のフレームの name を消し，追記の途中で止まったファイルにする
+        with h5py.File(path, "a") as f:
+            f["frames/name"].resize(nframes - 1, axis=0)
+        with ht.TrajectoryFile(path, "a") as traj:
+            truncated = len(traj) == nframes - 1
+            for group in groups:
+                npoints = sum(len(getattr(references[k], group).diagrams.points) for k in range(nframes - 1))
+                truncated &= traj._file[f"{group}/points"].shape[0] == npoints
+                truncated &= traj._file[f"{group}/index"].shape[0] == nframes - 1
+            truncated &= traj._file["threading/flags"].shape[0] == nframes - 1
+            traj.append(frame(nframes - 1), name=f"frame{nframes - 1}")
+            truncated &= len(traj) == nframes and same(references[-1], traj.read(-1))
+        print(f"Trajectory drops a half-written frame: {truncated}")
+    return ok and truncated
+
+
+def check_pipeline_write_error(timeout=20):
+    """
+    Check that FramePipeline.run raises the error of a failed write instead of
+    waiting forever for a reader that is slower than the computation.
+
+    args:
+    timeout: float
+        Seconds to wait for the pipeline before reporting a hang.
+
+    returns:
+    bool: True if the error was raised in time, False otherwise.
+    """
+    class FailingFrame:
+        def to_hdf5(self, filename, **kwargs):
+            raise OSError(f"cannot write {filename}")
+
+    def slow_frames():
+        for k in range(3):
+            time.sleep(0.3)
+            yield f"frame{k}", FailingFrame(), None
+
+    result = {}
+
+    def run():
+        try:
+            ht.FramePipeline(compute=lambda pds, coords: None).run(slow_frames())
+        except OSError as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    ok = not thread.is_alive() and "error" in result
+    print(f"Pipeline raises a failed write: {ok}")
+    return ok
+
 
 def validate_hdf5(file_path):
     """
@@ -190,8 +699,10 @@ def batch_test(input_dir, output_dir, pattern="*.data"):
             
             # Validate output file
             valid = validate_hdf5(output_file)
+            failed = failed_checks(result)
             results[base_name] = {
-                "success": True,
+                "success": not failed,
+                "error": f"failed checks: {', '.join(failed)}",
                 "valid_hdf5": valid,
                 "data": result
             }
@@ -242,10 +753,12 @@ if __name__ == "__main__":
         if not os.path.isdir(args.output):
             os.makedirs(args.output, exist_ok=True)
         
-        batch_test(args.input, args.output, args.pattern)
+        results = batch_test(args.input, args.output, args.pattern)
+        if not all(r["success"] for r in results.values()):
+            sys.exit(1)
     else:
         # Single file processing
-        test(
+        result = test(
             args.input, 
             args.output, 
         )
@@ -253,3 +766,8 @@ if __name__ == "__main__":
         # Validate output file
         if os.path.exists(args.output):
             validate_hdf5(args.output)
+
+        failed = failed_checks(result)
+        if failed:
+            print(f"Failed checks: {', '.join(failed)}")
+            sys.exit(1)